@@ -9,3 +9,4 @@ __version__ = "1.0.0"
 from .postgres import DBConn
 from .newspaper_enricher import NewspaperEnricher
 from .article_enricher import ArticleEnricher
+from .search import ArticleSearch
@@ -1,12 +1,15 @@
 """Module containing functions that enrich the data in articles table"""
 from datetime import datetime
-import pandas as pd
+import hashlib
 from psycopg2.extras import execute_values
+from mediaeye.pipeline_stats import FILTER_STATS, PipelineStats, stat_deltas_query
 from mediaeye.postgres import DBConn
 
 class ArticleEnricher:
     """Class that enriches articles table with automatic and manual data"""
-    
+    # Rows classified per UPDATE statement in apply_filter_status
+    filter_chunk_size = 50_000
+
     tag_dirs = set(["tag"])
     staff_dirs = set(["staff_name","author","staff_profile","authors"])
     ad_dirs = set(["ads","sponsored"])
@@ -17,8 +20,10 @@ class ArticleEnricher:
     article_dirs.update(("news","sports","uncategorized","archives","news-stories","opinion","articles","sports-stories","features","article","blog","lifestyles","opinions-stories","culture","flipbook_page","category","campus-news","post","life_and_culture-stories","lifestyle","uganews","featured","multimedia","variety","athensnews","people","new-blog","local","arts_and_entertainment","viewpoint","library","index.php","blogs","arts-life","views","arts","the_companion","p","arts-and-life","special-sections","academics","scene","buzz-stories","stories","opinions","entertainment","perspective","feature","arts-and-culture","gameday","event","cops","campus","story_segment","reviews","ac","top-stories","archive","af","offices","funnies","eat-drink","section"))
 
     def __init__(self) -> None:
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
+        self.stats = PipelineStats(self.cur)
+        self.dbconn.commit()
 
     @classmethod
     def _get_filter_status(cls, **kwargs):
@@ -36,36 +41,104 @@ class ArticleEnricher:
             return "article", False
         return "missing dir_1", False     
 
-    def apply_filter_status(self):
-        """Applies filter status to all rows in the articles table and updates the database."""
-        query_select = "SELECT id, dir_1 FROM articles"
-        query_update = """
-            UPDATE articles AS a
-            SET filter_status = b.filter_status,
-                is_filtered = b.is_filtered,
-                time_filtered = b.time_filtered
-            FROM (VALUES %s) AS b(id, filter_status, is_filtered, time_filtered)
-            WHERE a.id = b.id
-        """
-
-        try:
-            # Fetch all rows into a DataFrame
-            df = pd.read_sql(query_select, self.dbconn.connection)
+    @classmethod
+    def _filter_rules(cls):
+        """List of (dir, filter_status, is_filtered) rows, one per known dir_1 value,
+        following the precedence of _get_filter_status"""
+        rules = {}
+        for dirs, filter_status in [(cls.tag_dirs, "tag"), (cls.ad_dirs, "ad"),
+                                    (cls.staff_dirs, "staff"), (cls.article_dirs, "article")]:
+            for dir_1 in dirs:
+                rules.setdefault(dir_1, (dir_1, filter_status, True))
+        return sorted(rules.values())
 
-            # Process rows to compute filter_status and is_filtered
-            df["filter_status"], df["is_filtered"] = zip(
-                *df["dir_1"].apply(lambda dir_1: self._get_filter_status(dir_1=dir_1))
-            )
-            df["time_filtered"] = datetime.now()
+    @classmethod
+    def rules_version(cls):
+        """Short hash of the current filter rules, stored with each classified row"""
+        return hashlib.sha256(repr(cls._filter_rules()).encode()).hexdigest()[:12]
 
-            # Prepare the data for bulk update
-            update_data = df[["id", "filter_status", "is_filtered", "time_filtered"]].values.tolist()
+    def sync_filter_rules(self):
+        """Mirror the dir sets into the dir_filters lookup table"""
+        rules_version = self.rules_version()
+        execute_values(self.cur, """
+            INSERT INTO dir_filters (dir, filter_status, is_filtered, rules_version)
+            VALUES %s
+            ON CONFLICT (dir) DO UPDATE
+            SET filter_status = EXCLUDED.filter_status,
+                is_filtered = EXCLUDED.is_filtered,
+                rules_version = EXCLUDED.rules_version
+        """, [(*rule, rules_version) for rule in self._filter_rules()])
+        self.cur.execute("""
+            DELETE FROM dir_filters WHERE rules_version <> %s
+        """, (rules_version,))
 
-            # Perform bulk update
-            execute_values(self.cur, query_update, update_data)
+    def apply_filter_status(self, incremental=True):
+        """
+        Applies filter status to rows in the articles table inside postgres.
 
-            # Commit changes
+        The dir sets are synced to the dir_filters table, then rows are classified by looking
+        up their dir_1 in it, filter_chunk_size rows per UPDATE, committing after each.
+        Incrementally, never filtered rows are paged by id over articles_unfiltered_idx, and
+        rows filtered under older rules are only revisited when the rules changed since the
+        last sync. Otherwise every row is reclassified in id ranges, e.g. to finish a run
+        interrupted after its rules were synced.
+        """
+        rules_version = self.rules_version()
+        time_filtered = datetime.now()
+        try:
+            self.cur.execute("SELECT DISTINCT rules_version FROM dir_filters")
+            rules_changed = {row[0] for row in self.cur.fetchall()} != {rules_version}
+            self.sync_filter_rules()
+            self.dbconn.commit()
+            n_filtered = 0
+            if incremental:
+                last_id = 0
+                while True:
+                    self.cur.execute("""
+                        SELECT id FROM articles
+                        WHERE time_filtered IS NULL AND id > %s
+                        ORDER BY id
+                        LIMIT %s
+                    """, (last_id, self.filter_chunk_size))
+                    ids = [row[0] for row in self.cur.fetchall()]
+                    if not ids:
+                        break
+                    last_id = ids[-1]
+                    n_filtered += self._classify("id = ANY(%s)", (ids,), time_filtered, rules_version)
+            if rules_changed or not incremental:
+                stale_condition = "id >= %s AND id < %s"
+                if incremental:
+                    stale_condition += " AND time_filtered IS NOT NULL" \
+                        " AND filter_rules_version IS DISTINCT FROM %s"
+                self.cur.execute("SELECT MIN(id), MAX(id) FROM articles")
+                min_id, max_id = self.cur.fetchone()
+                self.dbconn.commit()
+                for chunk_start in range(min_id or 0, (max_id or -1) + 1, self.filter_chunk_size):
+                    params = (chunk_start, chunk_start + self.filter_chunk_size)
+                    if incremental:
+                        params += (rules_version,)
+                    n_filtered += self._classify(stale_condition, params, time_filtered, rules_version)
+            print(f"{n_filtered} articles filtered with rules {rules_version}")
+            self.stats.write()
             self.dbconn.commit()
         except Exception as e:
             self.dbconn.rollback()
             print(f"Error: {e}")
+
+    def _classify(self, condition, params, time_filtered, rules_version):
+        """Classify the articles matching condition and commit, returning how many were updated"""
+        self.cur.execute(stat_deltas_query('articles', FILTER_STATS, condition, f"""
+            UPDATE articles AS a
+            SET filter_status = COALESCE((SELECT f.filter_status FROM dir_filters AS f
+                                          WHERE f.dir = a.dir_1), 'article'),
+                is_filtered = COALESCE((SELECT f.is_filtered FROM dir_filters AS f
+                                        WHERE f.dir = a.dir_1), FALSE),
+                time_filtered = %s,
+                filter_rules_version = %s
+            WHERE {condition}
+            RETURNING a.*
+        """), (*params, time_filtered, rules_version, *params))
+        n_updated, *deltas = self.cur.fetchone()
+        self.dbconn.commit()
+        self.stats.add(dict(zip(FILTER_STATS, deltas)))
+        return n_updated
@@ -4,23 +4,106 @@ import re
 import time
 import json
 import requests
-from bs4 import BeautifulSoup
 from .items import ArticleItem
+from .parsed_document import ParsedDocument, parse_document
+
+class PriorityMatcher:
+    """
+    Finds the highest priority match among several regex patterns in one scan of a text.
+
+    Behaves like calling `re.search` with each pattern in order and keeping the first match
+    that `parse` accepts. The first pattern wins wherever it occurs, so it is searched for
+    alone first; the others are compiled once into a single lookahead scanner that walks the
+    text once and stops as soon as the winning pattern is known.
+    """
+    _UNSEEN = object()
+
+    def __init__(self, patterns) -> None:
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.scanner = None
+        if len(patterns) > 1:
+            self.scanner = re.compile("(?=" + "|".join(f"(?:{pattern})" for pattern in patterns[1:]) + ")")
+
+    def search(self, text, parse=lambda index, match: match):
+        """
+        Return `parse(index, match)` for the first occurrence of the highest priority pattern
+        whose first occurrence parses to something other than None.
+
+        Args:
+            text (str): The text to scan.
+            parse (callable): Maps a pattern index and its match to a value, or None to reject.
+
+        Returns:
+            The parsed value, or None if no pattern yields one.
+        """
+        results = [self._UNSEEN] * len(self.patterns)
+        # A plain search is far quicker than the combined scan when the first pattern only
+        # occurs late in the text, and its first match decides the result if it parses
+        match = self.patterns[0].search(text)
+        results[0] = parse(0, match) if match else None
+        if results[0] is not None or self.scanner is None:
+            return results[0]
+        for hit in self.scanner.finditer(text):
+            position = hit.start()
+            for index, pattern in enumerate(self.patterns):
+                if results[index] is self._UNSEEN:
+                    match = pattern.match(text, position)
+                    if match:
+                        results[index] = parse(index, match)
+            # Stop once every higher priority pattern has been seen and rejected
+            for result in results:
+                if result is self._UNSEEN:
+                    break
+                if result is not None:
+                    return result
+            else:
+                return None
+        for result in results:
+            if result is not self._UNSEEN and result is not None:
+                return result
+        return None
 
 class ArticleExtractor:
     """
     Class to extract information (author, date, content) from a newspaper article given its link.
     """
+    # Patterns for date extraction, in order of precedence
+    date_patterns = [
+        (r"\b(\d{4}-\d{2}-\d{2})\b", '%Y-%m-%d'),  # YYYY-MM-DD
+        (r"\b(\d{4}/\d{2}/\d{2})\b", '%Y/%m/%d'),  # YYYY/MM/DD
+        (r"\b(\d{2}/\d{2}/\d{4})\b", '%m/%d/%Y'),  # MM/DD/YYYY
+        (r"\b(\d{1,2} \w+ \d{4})\b", '%B %d, %Y'),  # Month Day, YYYY
+        (r"\b(\w+ \d{1,2}, \d{4})\b", '%B %d, %Y'),  # Month Day, YYYY
+        (r"\b(\w+\.\s\d{1,2},\s\d{4})\b", '%B. %d, %Y'),  # Month. Day, YYYY
+        (r"\b(\w+\s\d{1,2},\s\d{4})\b", '%B %d, %Y'),  # Month Day, YYYY
+    ]
+    # Patterns for author extraction, in order of precedence
+    author_patterns = [
+        r"\bBy\s+([\w\s]+)\b",  # By Author Name
+        r"\bAuthor:\s+([\w\s]+)\b",  # Author: Author Name
+    ]
+    date_matcher = PriorityMatcher([pattern for pattern, _ in date_patterns])
+    author_matcher = PriorityMatcher(author_patterns)
+
     def __init__(self) -> None:
         pass
 
     @staticmethod
-    def get_date(soup):
+    def _parse_date_match(index, match):
+        """Parse a date pattern match into 'YYYY-MM-DD', or None if it is not a valid date"""
+        try:
+            date_obj = datetime.strptime(match.group(0), ArticleExtractor.date_patterns[index][1])
+            return date_obj.strftime('%Y-%m-%d')
+        except ValueError:
+            return None
+
+    @staticmethod
+    def get_date(doc: ParsedDocument):
         """
-        Extracts the publication date of the newspaper article from the BeautifulSoup object.
+        Extracts the publication date of the newspaper article from the parsed document.
 
         Args:
-            soup (BeautifulSoup): The BeautifulSoup object of the article's HTML.
+            doc (ParsedDocument): The parsed document of the article's HTML.
 
         Returns:
             str: The publication date in 'YYYY-MM-DD' format.
@@ -30,9 +113,8 @@ class ArticleExtractor:
 
         # Loop through the possible field names and attempt to extract the date from meta fields
         for field_name in date_field_names:
-            date_tag = soup.find('meta', {'name': field_name})
-            if date_tag:
-                date_str = date_tag.get('content')
+            date_str = doc.meta.get(field_name)
+            if date_str:
                 try:
                     # Parse the date string into a datetime object
                     date_obj = datetime.strptime(date_str, '%Y-%m-%d')
@@ -40,61 +122,31 @@ class ArticleExtractor:
                 except ValueError:
                     pass  # Continue to the next field if parsing fails
 
-       # Define patterns for date extraction
-        date_patterns = [
-            (r"\b(\d{4}-\d{2}-\d{2})\b", '%Y-%m-%d'),  # YYYY-MM-DD
-            (r"\b(\d{4}/\d{2}/\d{2})\b", '%Y/%m/%d'),  # YYYY/MM/DD
-            (r"\b(\d{2}/\d{2}/\d{4})\b", '%m/%d/%Y'),  # MM/DD/YYYY
-            (r"\b(\d{1,2} \w+ \d{4})\b", '%B %d, %Y'),  # Month Day, YYYY
-            (r"\b(\w+ \d{1,2}, \d{4})\b", '%B %d, %Y'),  # Month Day, YYYY
-            (r"\b(\w+\.\s\d{1,2},\s\d{4})\b", '%B. %d, %Y'),  # Month. Day, YYYY
-            (r"\b(\w+\s\d{1,2},\s\d{4})\b", '%B %d, %Y'),  # Month Day, YYYY
-        ]
-
-        # Extract date from different patterns in the HTML content
-        for pattern, date_format in date_patterns:
-            date_match = re.search(pattern, str(soup))
-            if date_match:
-                date_str = date_match.group(0)
-                try:
-                    # Parse the date string into a datetime object
-                    date_obj = datetime.strptime(date_str, date_format)
-                    return date_obj.strftime('%Y-%m-%d')
-                except ValueError:
-                    pass  # Continue to the next pattern if parsing fails
-
-        # If no valid date is found in the meta fields or content, return "No date found"
-        return None
+        # Extract the first date of the highest priority pattern in the HTML content
+        return ArticleExtractor.date_matcher.search(doc.html, ArticleExtractor._parse_date_match)
 
     
     @staticmethod
-    def get_author(soup):
+    def get_author(doc: ParsedDocument):
         """
-        Extracts the author of the newspaper article from the BeautifulSoup object.
+        Extracts the author of the newspaper article from the parsed document.
 
         Args:
-            soup (BeautifulSoup): The BeautifulSoup object of the article's HTML.
+            doc (ParsedDocument): The parsed document of the article's HTML.
 
         Returns:
             str: The author's name or "Unknown" if not found.
         """
-         # Define patterns for author extraction
-        author_patterns = [
-            (r"\bBy\s+([\w\s]+)\b", '%s'),  # By Author Name
-            (r"\bAuthor:\s+([\w\s]+)\b", '%s'),  # Author: Author Name
-        ]
-
-        # Extract author from different patterns in the HTML content
-        for pattern, author_format in author_patterns:
-            author_match = re.search(pattern, str(soup.get_text()))
-            if author_match:
-                author_name = author_match.group(1)
-                return author_format % author_name.strip()
+        # Extract author from the highest priority pattern in the text content
+        author_name = ArticleExtractor.author_matcher.search(
+            doc.text, lambda index, match: match.group(1).strip())
+        if author_name is not None:
+            return author_name
 
         # If no valid author is found in the content, check for author tags
-        author_tag = soup.find('meta', {'name': 'author'})
-        if author_tag:
-            return author_tag.get('content').strip()
+        author = doc.meta.get('author')
+        if author:
+            return author.strip()
         
         # If still no author is found, try finding all tags and IDs containing "author"
         # author_candidates = []
@@ -111,48 +163,65 @@ class ArticleExtractor:
         return None
 
     @staticmethod
-    def get_article(soup):
+    def get_article(doc: ParsedDocument):
         """
-        Extracts the article content of the newspaper article from the BeautifulSoup object.
+        Extracts the article content of the newspaper article from the parsed document.
 
         Args:
-            soup (BeautifulSoup): The BeautifulSoup object of the article's HTML.
+            doc (ParsedDocument): The parsed document of the article's HTML.
 
         Returns:
             str: The article's content as a plain text string or "No content found" if not found.
         """
-        content_tags = soup.find_all('p')  # Get all <p> tags
-        article = '\n\n'.join(tag.get_text().strip() for tag in content_tags) if content_tags else None
+        paragraphs = doc.paragraphs  # Text of all <p> tags
+        article = '\n\n'.join(paragraphs) if paragraphs else None
         return article
     
     @staticmethod
-    def get_title(soup):
+    def get_title(doc: ParsedDocument):
         """
-        Extracts the content of the newspaper article from the BeautifulSoup object.
+        Extracts the content of the newspaper article from the parsed document.
 
         Args:
-            soup (BeautifulSoup): The BeautifulSoup object of the article's HTML.
+            doc (ParsedDocument): The parsed document of the article's HTML.
 
         Returns:
             str: The article's content as a plain text string or "No content found" if not found.
         """
         # TODO: Improve Implementation
         # Find the title tag and extract its text
-        title_tag = soup.find('title')
-        if title_tag:
-            return title_tag.text.strip()
+        if doc.title is not None:
+            return doc.title.strip()
         
         return None
 
     @staticmethod
-    def set_fields(item: ArticleItem, response):
-        """Set fields given an item object and its soup"""
-        soup = BeautifulSoup(response.text, 'html.parser')
-        item['author'] = ArticleExtractor.get_author(soup)
-        item['date_written'] = ArticleExtractor.get_date(soup)
-        item['processed_article'] = ArticleExtractor.get_article(soup)
-        item['title'] = ArticleExtractor.get_title(soup)
-        item['processing_method'] = 1
+    def extract_fields(html, backend=None):
+        """
+        Extract the article fields of a page, parsing it once.
+
+        Only takes and returns picklable values so it can run in a worker process.
+
+        Args:
+            html (str): The page's HTML.
+            backend (str): The parsed_document backend to use.
+
+        Returns:
+            dict: Values for the ArticleItem fields set by extraction.
+        """
+        doc = parse_document(html, backend)
+        return {
+            'author': ArticleExtractor.get_author(doc),
+            'date_written': ArticleExtractor.get_date(doc),
+            'processed_article': ArticleExtractor.get_article(doc),
+            'title': ArticleExtractor.get_title(doc),
+            'processing_method': 1,
+        }
+
+    @staticmethod
+    def set_fields(item: ArticleItem, response, backend=None):
+        """Set fields given an item object and its response"""
+        item.update(ArticleExtractor.extract_fields(response.text, backend))
 
     @staticmethod
     def get_fields(article_link):
@@ -163,25 +232,25 @@ class ArticleExtractor:
             request_time = end_time - start_time
 
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+                doc = parse_document(response.text)
 
                 start_time = time.time()
-                author = ArticleExtractor.get_author(soup)
+                author = ArticleExtractor.get_author(doc)
                 end_time = time.time()
                 author_extraction_time = end_time - start_time
 
                 start_time = time.time()
-                current_date = ArticleExtractor.get_date(soup)
+                current_date = ArticleExtractor.get_date(doc)
                 end_time = time.time()
                 date_extraction_time = end_time - start_time
 
                 start_time = time.time()
-                content = ArticleExtractor.get_article(soup)
+                content = ArticleExtractor.get_article(doc)
                 end_time = time.time()
                 content_extraction_time = end_time - start_time
 
                 start_time = time.time()
-                title = ArticleExtractor.get_title(soup)
+                title = ArticleExtractor.get_title(doc)
                 end_time = time.time()
                 title_extraction_time = end_time - start_time
 
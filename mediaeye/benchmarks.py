@@ -0,0 +1,225 @@
+"""Module for benchmarking hot paths of the pipeline against saved data."""
+from concurrent import futures
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+import pandas as pd
+from mediaeye.article_extractor import ArticleExtractor
+from mediaeye.content_store import ContentStore
+from mediaeye.parsed_document import parse_document
+from mediaeye.postgres import DBConn
+from mediaeye.sitemaps import _fetch_sitemap, sitemap_to_df
+from mediaeye.urls import url_dirs
+
+def save_article_corpus(directory, n=200):
+    """Save the content of n scraped articles to directory as html files"""
+    os.makedirs(directory, exist_ok=True)
+    dbconn = DBConn(pooled=True)
+    dbconn.cur.execute("""
+        SELECT a.id, a.content, c.body
+        FROM articles a
+        LEFT JOIN article_contents c ON c.hash = a.content_hash
+        WHERE a.content IS NOT NULL OR a.content_hash IS NOT NULL
+        LIMIT %s
+    """, (n,))
+    for article_id, content, body in dbconn.cur.fetchall():
+        if content is None:
+            content = ContentStore.decompress(body)
+        with open(os.path.join(directory, f"{article_id}.html"), 'w', encoding='utf-8') as f:
+            f.write(content)
+    dbconn.close()
+
+def load_article_corpus(directory):
+    """Load all html files in directory"""
+    pages = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith('.html'):
+            with open(os.path.join(directory, file_name), encoding='utf-8') as f:
+                pages.append(f.read())
+    return pages
+
+def _search_patterns_in_turn(doc):
+    """Date and author lookup as done before PriorityMatcher, one re.search per pattern"""
+    found_date = None
+    for pattern, date_format in ArticleExtractor.date_patterns:
+        date_match = re.search(pattern, doc.html)
+        if date_match:
+            try:
+                found_date = datetime.strptime(date_match.group(0), date_format).strftime('%Y-%m-%d')
+                break
+            except ValueError:
+                pass
+    found_author = None
+    for pattern in ArticleExtractor.author_patterns:
+        author_match = re.search(pattern, doc.text)
+        if author_match:
+            found_author = author_match.group(1).strip()
+            break
+    return found_date, found_author
+
+def _search_with_matchers(doc):
+    """Date and author lookup through the compiled PriorityMatchers"""
+    found_date = ArticleExtractor.date_matcher.search(doc.html, ArticleExtractor._parse_date_match)
+    found_author = ArticleExtractor.author_matcher.search(
+        doc.text, lambda index, match: match.group(1).strip())
+    return found_date, found_author
+
+def benchmark_matchers(directory, repeat=3):
+    """
+    Time date and author matching per page on a saved corpus, before and after PriorityMatcher.
+
+    Pages are parsed up front so only the matching is timed. Prints mean milliseconds per page
+    for both approaches and the number of pages where their results disagree.
+    """
+    docs = [parse_document(page) for page in load_article_corpus(directory)]
+    if not docs:
+        print(f"No pages found in {directory}")
+        return None
+    for doc in docs:
+        # Fill the cached views so parsing is not timed
+        _ = doc.text
+    timings = {}
+    results = {}
+    for name, func in [('before', _search_patterns_in_turn), ('after', _search_with_matchers)]:
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            results[name] = [func(doc) for doc in docs]
+            elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best / len(docs) * 1000
+    mismatches = sum(before != after for before, after in zip(results['before'], results['after']))
+    print(f"{len(docs)} pages\n" +
+          f"before: {timings['before']:.3f} ms/page\n" +
+          f"after:  {timings['after']:.3f} ms/page\n" +
+          f"{mismatches} pages with differing results")
+    return timings
+
+def _synthetic_sitemap_df(n, seed=0):
+    """Sitemap-like frame of n article urls with varying depth, queries and encoded segments"""
+    rng = random.Random(seed)
+    sections = ['news', 'sports', 'opinion', 'arts', 'features', '2023', '2024', 'caf%C3%A9']
+    urls = []
+    for i in range(n):
+        depth = rng.randint(0, 6)
+        path = '/'.join(rng.choice(sections) for _ in range(depth))
+        slug = f"story-{i}" + ('?page=2' if i % 50 == 0 else '')
+        urls.append(f"https://paper{i % 300}.example.edu/{path}/{slug}")
+    return pd.DataFrame({'loc': urls, 'sitemap': 'https://example.edu/sitemap.xml'})
+
+def benchmark_url_split(n=1_000_000, check=10_000):
+    """
+    Time splitting n sitemap urls into articles' dir columns, with advertools url_to_df plus
+    merge as before and with url_dirs as now.
+
+    Prints seconds for both and the number of differing rows among the first `check` urls.
+    """
+    from advertools import url_to_df
+    sitemap_df = _synthetic_sitemap_df(n)
+    columns = ['dir_1', 'dir_2', 'dir_3', 'dir_4', 'dir_5', 'last_dir']
+
+    def before(df):
+        url_df = url_to_df(df['loc'])
+        merged_df = pd.merge(df, url_df, left_on='loc', right_on='url', how='inner')
+        for col in columns:
+            if col not in merged_df.columns:
+                merged_df[col] = None
+        return merged_df
+
+    def after(df):
+        return pd.concat([df, url_dirs(df['loc'])], axis=1)
+
+    timings = {}
+    for name, func in [('before', before), ('after', after)]:
+        start_time = time.perf_counter()
+        func(sitemap_df)
+        timings[name] = time.perf_counter() - start_time
+    sample_df = sitemap_df.head(check)
+    before_rows = before(sample_df)[columns].astype(object)
+    before_rows = before_rows.where(before_rows.notna() & (before_rows != ""), None)
+    after_rows = after(sample_df)[columns]
+    mismatches = sum(b != a for b, a in zip(before_rows.itertuples(index=False),
+                                            after_rows.itertuples(index=False)))
+    print(f"{n} urls\n" +
+          f"before: {timings['before']:.2f} s\n" +
+          f"after:  {timings['after']:.2f} s\n" +
+          f"{mismatches} of {len(sample_df)} checked rows differ")
+    return timings
+
+def _write_sitemap_index(directory, base_url, n_children, urls_per_child):
+    """Write sitemap_index.xml listing n_children sitemaps of urls_per_child urls each"""
+    with open(os.path.join(directory, 'sitemap_index.xml'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for i in range(n_children):
+            f.write(f"<sitemap><loc>{base_url}sitemap_{i}.xml</loc></sitemap>\n")
+        f.write('</sitemapindex>\n')
+    for i in range(n_children):
+        with open(os.path.join(directory, f'sitemap_{i}.xml'), 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for j in range(urls_per_child):
+                f.write(f"<url><loc>{base_url}news/{i}/story-{j}</loc>"
+                        f"<lastmod>2024-01-{j % 28 + 1:02d}</lastmod></url>\n")
+            f.write('</urlset>\n')
+
+def _sitemap_to_df_before(sitemap_url, max_workers=8):
+    """Index assembly as done before: an executor per index and a concat per child"""
+    fetch = _fetch_sitemap(sitemap_url, True, None, None, None, None)
+    chunks = []
+    while True:
+        try:
+            chunks.append(next(fetch))
+        except StopIteration as done:
+            children, _ = done.value
+            break
+    if children is None:
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    multi_sitemap_df = pd.DataFrame()
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        to_do = [executor.submit(_sitemap_to_df_before, child) for child in children]
+        for future in futures.as_completed(to_do):
+            multi_sitemap_df = pd.concat([multi_sitemap_df, future.result()], ignore_index=True)
+    return multi_sitemap_df
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def benchmark_sitemap_index(n_children=1200, urls_per_child=100, max_workers=8):
+    """
+    Time and measure peak traced memory of reading a sitemap index of n_children sitemaps
+    served from a local http.server, before and after the shared-executor rewrite.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietHandler, directory=directory))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+        try:
+            _write_sitemap_index(directory, base_url, n_children, urls_per_child)
+            index_url = base_url + 'sitemap_index.xml'
+            results = {}
+            for name, func in [('before', _sitemap_to_df_before), ('after', sitemap_to_df)]:
+                tracemalloc.start()
+                start_time = time.perf_counter()
+                sitemap_df = func(index_url, max_workers=max_workers)
+                elapsed = time.perf_counter() - start_time
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                results[name] = {'seconds': elapsed, 'peak_mb': peak / 1024 / 1024,
+                                 'rows': len(sitemap_df)}
+        finally:
+            server.shutdown()
+            server.server_close()
+    for name, result in results.items():
+        print(f"{name}: {result['seconds']:.2f} s, peak {result['peak_mb']:.1f} MB, " +
+              f"{result['rows']} rows")
+    return results
@@ -0,0 +1,145 @@
+"""Module providing a Bloom filter of article links already stored in the articles table."""
+import hashlib
+import json
+import math
+import os
+import struct
+
+MAGIC = b"MEBLOOM1"
+DEFAULT_BLOOM_PATH = "known_links.bloom"
+DEFAULT_ERROR_RATE = 1e-6
+# Links are keyed like articles' UNIQUE (link), the target of the inserts' ON CONFLICT, so
+# a link in the filter is one the table would reject whichever newspaper it came from
+KEY_COLUMN = 'link'
+
+class BloomFilter:
+    """
+    Compact set of strings answering "definitely not seen" or "probably seen".
+
+    A link the filter reports as seen may be new with probability `false_positive_rate()`,
+    so the error rate is kept low: screening drops that fraction of new links.
+
+    Args:
+        capacity (int): Number of items the filter is sized for.
+        error_rate (float): Target false positive rate at capacity.
+    """
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE) -> None:
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.n_bits = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(round(self.n_bits / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+        self.meta = {}
+
+    def _positions(self, item: str):
+        """Bit positions of an item, by double hashing one blake2b digest"""
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        h2 |= 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, item: str) -> bool:
+        """Add an item, True if it was not already (probably) present"""
+        is_new = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+        return is_new
+
+    def update(self, items) -> None:
+        """Add every item"""
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def false_positive_rate(self) -> float:
+        """Expected false positive rate at the current number of items"""
+        return (1 - math.exp(-self.n_hashes * self.count / self.n_bits)) ** self.n_hashes
+
+    def save(self, path) -> None:
+        """Write the filter and its meta to path, atomically"""
+        header = json.dumps({'capacity': self.capacity, 'error_rate': self.error_rate,
+                             'n_bits': self.n_bits, 'n_hashes': self.n_hashes,
+                             'count': self.count, 'meta': self.meta}).encode('utf-8')
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written by `save`"""
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a saved BloomFilter")
+            (header_size,) = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_size))
+            bits = bytearray(f.read())
+        bloom = cls.__new__(cls)
+        bloom.capacity = header['capacity']
+        bloom.error_rate = header['error_rate']
+        bloom.n_bits = header['n_bits']
+        bloom.n_hashes = header['n_hashes']
+        bloom.count = header['count']
+        bloom.meta = header['meta']
+        bloom.bits = bits
+        if len(bits) != (bloom.n_bits + 7) // 8:
+            raise ValueError(f"{path} is truncated")
+        return bloom
+
+def _add_links_after(bloom, dbconn, min_id) -> int:
+    """Stream links with id > min_id into the filter and return the largest id seen"""
+    max_id = min_id
+    with dbconn.connection.cursor(name='known_links_cursor') as cur:
+        cur.itersize = 50_000
+        # Rows without a link can never conflict, and the max id is tracked from all rows
+        cur.execute(f"SELECT id, {KEY_COLUMN} FROM articles WHERE id > %s", (min_id,))
+        for article_id, link in cur:
+            if link is not None:
+                bloom.add(link)
+            max_id = max(max_id, article_id)
+    dbconn.commit()
+    return max_id
+
+def load_known_links(dbconn, path=DEFAULT_BLOOM_PATH, error_rate=DEFAULT_ERROR_RATE):
+    """
+    Filter of all links in articles, read from path and caught up with rows added since it
+    was saved. It is rebuilt from the table if the file is missing, unreadable, over capacity,
+    ahead of the table (e.g. after a purge) or keyed on other columns than KEY_COLUMN.
+
+    The filter's meta['max_id'] records the largest article id it covers and meta['key']
+    the column its items come from.
+    """
+    dbconn.cur.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM articles")
+    n_links, table_max_id = dbconn.cur.fetchone()
+    bloom = None
+    if os.path.exists(path):
+        try:
+            bloom = BloomFilter.load(path)
+        except (ValueError, OSError, KeyError) as e:
+            print(f"Could not load {path}, rebuilding: {e}")
+    if bloom is not None and (bloom.meta.get('max_id', 0) > table_max_id
+                              or n_links > bloom.capacity
+                              or bloom.meta.get('key') != KEY_COLUMN):
+        bloom = None
+    if bloom is None:
+        # Room to grow before the next rebuild
+        bloom = BloomFilter(max(n_links * 2, 100_000), error_rate)
+        bloom.meta['max_id'] = 0
+        bloom.meta['key'] = KEY_COLUMN
+    bloom.meta['max_id'] = _add_links_after(bloom, dbconn, bloom.meta['max_id'])
+    return bloom
@@ -0,0 +1,103 @@
+"""Module providing a compressed, content-addressed store for raw article pages."""
+import gzip
+import hashlib
+from psycopg2.extras import execute_values
+
+class ContentStore:
+    """
+    Stores raw pages gzip-compressed in the article_contents table, keyed by their sha256.
+
+    Identical pages served under different links are stored once, and articles reference
+    their page through articles.content_hash.
+    """
+    def __init__(self, cur) -> None:
+        self.cur = cur
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        """Hex sha256 of a page"""
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def compress(content: str) -> bytes:
+        """Gzip a page"""
+        return gzip.compress(content.encode('utf-8'), compresslevel=6)
+
+    @staticmethod
+    def decompress(body: bytes) -> str:
+        """Gunzip a stored page"""
+        return gzip.decompress(bytes(body)).decode('utf-8')
+
+    def is_available(self) -> bool:
+        """Whether the database has article_contents and articles.content_hash. Databases
+        created before the store need DBConn.migrate to add them."""
+        self.cur.execute("""
+            SELECT to_regclass('article_contents') IS NOT NULL AND EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                AND table_name = 'articles' AND column_name = 'content_hash'
+            )
+        """)
+        return self.cur.fetchone()[0]
+
+    def put_many(self, contents):
+        """
+        Store pages not already in the store.
+
+        Args:
+            contents (list): Page strings, None entries are skipped.
+
+        Returns:
+            list: The hash of each page, None where the page was None.
+        """
+        hashes = [self.content_hash(content) if content is not None else None
+                  for content in contents]
+        new_rows = {}
+        for content_hash, content in zip(hashes, contents):
+            if content_hash is not None and content_hash not in new_rows:
+                encoded_size = len(content.encode('utf-8'))
+                new_rows[content_hash] = (content_hash, self.compress(content), encoded_size)
+        if new_rows:
+            execute_values(self.cur, """
+                INSERT INTO article_contents (hash, body, size)
+                VALUES %s
+                ON CONFLICT (hash) DO NOTHING
+            """, list(new_rows.values()))
+        return hashes
+
+    def put(self, content):
+        """Store a single page and return its hash"""
+        return self.put_many([content])[0]
+
+    def get(self, content_hash):
+        """Return the page stored under a hash, or None"""
+        self.cur.execute("""
+            SELECT body FROM article_contents WHERE hash = %s
+        """, (content_hash,))
+        row = self.cur.fetchone()
+        return self.decompress(row[0]) if row else None
+
+    def migrate_from_articles(self, dbconn, batch_size=1000):
+        """Move pages still held in articles.content into the store, committing per batch"""
+        n_moved = 0
+        while True:
+            self.cur.execute("""
+                SELECT id, content FROM articles
+                WHERE content IS NOT NULL AND content_hash IS NULL
+                LIMIT %s
+            """, (batch_size,))
+            rows = self.cur.fetchall()
+            if not rows:
+                break
+            hashes = self.put_many([content for _, content in rows])
+            execute_values(self.cur, """
+                UPDATE articles AS a
+                SET content_hash = v.content_hash, content = NULL
+                FROM (VALUES %s) AS v(id, content_hash)
+                WHERE a.id = v.id
+            """, [(article_id, content_hash)
+                  for (article_id, _), content_hash in zip(rows, hashes)])
+            dbconn.commit()
+            n_moved += len(rows)
+            print(f"{n_moved} article pages moved to the content store")
+        return n_moved
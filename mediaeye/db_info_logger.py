@@ -1,37 +1,47 @@
 """Moduler for logging information about the DB"""
+from mediaeye.pipeline_stats import PipelineStats, TABLE_STATS, scan_counts
 from mediaeye.postgres import DBConn
 
-def log():
-    """Log general information about the DB."""
-    conn = DBConn()
-    def count_entries(table, condition=None, params=None):
-        """Helper function to count entries in the database."""
-        query = f"SELECT COUNT(*) FROM {table}"
-        if condition:
-            query += f" WHERE {condition}"
-        conn.cur.execute(query, params or ())
-        count = conn.cur.fetchone()
-        return count[0]
-    
+def log(use_stats=True):
+    """
+    Log general information about the DB.
+
+    Each table is counted in a single scan. If the pipeline_stats table exists and use_stats
+    is set, article counts are read from it instead of scanning articles.
+    """
+    conn = DBConn(pooled=True)
+
     # Gather data
-    n_schools = count_entries('schools')
-    n_amcha_entries = count_entries('schools', 'amcha_name IS NOT NULL')
-    n_wiki_entries = count_entries('schools', 'name IS NOT NULL')
-    n_joint_entries = count_entries('schools', 'name IS NOT NULL AND amcha_name IS NOT NULL')
-    n_link_entries = count_entries('newspapers', 'link IS NOT NULL')
-    n_inspected_entries = count_entries('newspapers', 'link_is_accurate IS NOT NULL')
-    n_accurate_entries = count_entries('newspapers', 'link_is_accurate IS TRUE')
-    n_wordpress_entries = count_entries('newspapers', 'link_is_accurate IS TRUE AND is_wordpress IS TRUE')
-    n_incidents = count_entries('incidents')
-    n_physical_assault_incidents = count_entries('incidents', "physical_assault IS TRUE")
-    n_links = count_entries('articles')
-    n_nonarticle_links = count_entries('articles', "filter_status != %s AND is_filtered IS TRUE", ('article',))
-    n_article_links = count_entries('articles', "filter_status = %s AND is_filtered IS TRUE", ('article',))
-    n_content_articles = count_entries('articles', "content IS NOT NULL")
-    n_israel_articles = count_entries('articles', "title ILIKE %s", ("%Israel%",))
-    
+    counts = {}
+    for table in ['schools', 'newspapers', 'incidents']:
+        counts.update(scan_counts(conn.cur, table))
+    stats = PipelineStats(conn.cur).read() if use_stats else {}
+    article_stats = TABLE_STATS['articles']
+    if stats and all(name in stats for name in article_stats):
+        counts.update({name: stats[name][0] for name in article_stats})
+        oldest_update = min(stats[name][1] for name in article_stats)
+        print(f"Article counts read from pipeline_stats, oldest counter updated {oldest_update}.")
+    else:
+        counts.update(scan_counts(conn.cur, 'articles'))
+
     conn.close()
-    
+
+    n_schools = counts['schools']
+    n_amcha_entries = counts['amcha_entries']
+    n_wiki_entries = counts['wiki_entries']
+    n_joint_entries = counts['joint_entries']
+    n_link_entries = counts['link_entries']
+    n_inspected_entries = counts['inspected_entries']
+    n_accurate_entries = counts['accurate_entries']
+    n_wordpress_entries = counts['wordpress_entries']
+    n_incidents = counts['incidents']
+    n_physical_assault_incidents = counts['physical_assault_incidents']
+    n_links = counts['links']
+    n_nonarticle_links = counts['nonarticle_links']
+    n_article_links = counts['article_links']
+    n_content_articles = counts['content_articles']
+    n_israel_articles = counts['israel_articles']
+
     # Calculate padding
     max_width = len(f"{max(n_schools, n_amcha_entries, n_wiki_entries, n_joint_entries, n_link_entries, n_inspected_entries, n_accurate_entries, n_wordpress_entries, n_incidents, n_links, n_nonarticle_links, n_article_links, n_content_articles, n_israel_articles):,}")
     
@@ -0,0 +1,101 @@
+"""Module providing a persistent cache of HTTP validators for robots.txt files and sitemaps."""
+import hashlib
+import threading
+from datetime import datetime
+from psycopg2.extras import execute_values
+
+class FetchCache:
+    """
+    Per-URL cache of ETag/Last-Modified validators and body hashes, kept in the fetch_cache table.
+
+    Fetchers send `request_headers(url)` so unchanged resources come back as 304, and compare
+    body hashes with `is_unchanged` for servers that ignore validators. For robots.txt files
+    and sitemap indexes the listed sitemaps are cached too, so an unchanged one can still be
+    followed to sitemaps that changed.
+
+    New entries are held as pending under an owner (e.g. a newspaper id) until `flush`.
+    `discard` drops them and ignores the owner's later entries, so a resource is only marked
+    as seen once its data is stored.
+    """
+    def __init__(self, dbconn) -> None:
+        self.dbconn = dbconn
+        self.entries = {}
+        self.pending = {}
+        self.failed_owners = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def body_hash(body: bytes) -> str:
+        """Hex sha256 of a response body"""
+        return hashlib.sha256(body).hexdigest()
+
+    def load(self):
+        """Load all cached entries"""
+        self.dbconn.cur.execute("""
+            SELECT url, etag, last_modified, body_hash, sitemaps FROM fetch_cache
+        """)
+        self.entries = {
+            url: {'etag': etag, 'last_modified': last_modified,
+                  'body_hash': body_hash, 'sitemaps': sitemaps}
+            for url, etag, last_modified, body_hash, sitemaps in self.dbconn.cur.fetchall()
+        }
+
+    def request_headers(self, url) -> dict:
+        """Conditional request headers for a url, empty if it was never fetched"""
+        entry = self.entries.get(url)
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def is_unchanged(self, url, body_hash) -> bool:
+        """Whether a url's body hashes the same as when it was last fetched"""
+        entry = self.entries.get(url)
+        return entry is not None and entry['body_hash'] == body_hash
+
+    def sitemaps(self, url):
+        """Sitemaps listed in a cached robots.txt or sitemap index, or None"""
+        entry = self.entries.get(url)
+        return entry['sitemaps'] if entry else None
+
+    def record(self, url, etag=None, last_modified=None, body_hash=None, sitemaps=None, owner=None):
+        """Remember a fetched url, pending until its owner is flushed"""
+        entry = {'etag': etag, 'last_modified': last_modified,
+                 'body_hash': body_hash, 'sitemaps': sitemaps}
+        with self.lock:
+            if owner not in self.failed_owners:
+                self.pending.setdefault(owner, {})[url] = entry
+
+    def discard(self, owner=None):
+        """Drop an owner's pending and future entries, e.g. when storing its data failed"""
+        with self.lock:
+            self.pending.pop(owner, None)
+            self.failed_owners.add(owner)
+
+    def flush(self, owner=None, all_owners=False):
+        """Write an owner's (or every owner's) pending entries. Does not commit."""
+        with self.lock:
+            if all_owners:
+                pending = {}
+                for entries in self.pending.values():
+                    pending.update(entries)
+                self.pending = {}
+            else:
+                pending = self.pending.pop(owner, {})
+        if not pending:
+            return
+        now = datetime.now()
+        execute_values(self.dbconn.cur, """
+            INSERT INTO fetch_cache (url, etag, last_modified, body_hash, sitemaps, time_fetched)
+            VALUES %s
+            ON CONFLICT (url) DO UPDATE
+            SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified,
+                body_hash = EXCLUDED.body_hash, sitemaps = EXCLUDED.sitemaps,
+                time_fetched = EXCLUDED.time_fetched
+        """, [(url, entry['etag'], entry['last_modified'], entry['body_hash'],
+               entry['sitemaps'], now) for url, entry in pending.items()])
+        self.entries.update(pending)
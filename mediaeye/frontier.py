@@ -0,0 +1,97 @@
+"""Module providing a lease-based crawl frontier over the articles table."""
+import os
+import socket
+from datetime import timedelta
+
+# Articles that still need their page fetched
+PENDING_ARTICLES_CONDITION = """content IS NULL
+        AND content_hash IS NULL
+        AND filter_status = 'article'
+        AND is_filtered IS TRUE"""
+
+class ArticleFrontier:
+    """
+    Hands out pending articles to any number of workers sharing the database.
+
+    Workers claim batches with SELECT ... FOR UPDATE SKIP LOCKED, stamping each row with
+    their id and a lease expiry, so concurrent claims never overlap. Rows stop being pending
+    once their content is stored. If a worker dies, its leases expire and the rows can be
+    claimed again.
+
+    A claimed batch can take longer than a lease to be fetched (e.g. under AutoThrottle),
+    so workers `renew` the leases of rows still queued every `renew_interval` seconds, a
+    third of the lease. Batch size and lease length are then independent: a live worker
+    keeps its rows however slowly it fetches, and a dead one loses them within one lease.
+    """
+    def __init__(self, dbconn, worker_id=None, lease_minutes=30) -> None:
+        self.dbconn = dbconn
+        self.cur = dbconn.cur
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_duration = timedelta(minutes=lease_minutes)
+        self.renew_interval = self.lease_duration.total_seconds() / 3
+
+    def claim(self, n):
+        """Lease up to n pending articles to this worker and return their (id, link) rows"""
+        try:
+            self.cur.execute(f"""
+                UPDATE articles AS a
+                SET lease_owner = %s, lease_expires = NOW() + %s
+                FROM (
+                    SELECT id FROM articles
+                    WHERE {PENDING_ARTICLES_CONDITION}
+                    AND (lease_expires IS NULL OR lease_expires < NOW())
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) AS c
+                WHERE a.id = c.id
+                RETURNING a.id, a.link
+            """, (self.worker_id, self.lease_duration, n))
+            rows = self.cur.fetchall()
+            self.dbconn.commit()
+            return rows
+        except Exception:
+            self.dbconn.rollback()
+            raise
+
+    def renew(self, ids):
+        """Extend this worker's leases on ids by a full lease, returning how many it still held"""
+        if not ids:
+            return 0
+        try:
+            self.cur.execute("""
+                UPDATE articles
+                SET lease_expires = NOW() + %s
+                WHERE id = ANY(%s) AND lease_owner = %s
+            """, (self.lease_duration, list(ids), self.worker_id))
+            n_renewed = self.cur.rowcount
+            self.dbconn.commit()
+            return n_renewed
+        except Exception:
+            self.dbconn.rollback()
+            raise
+
+    def release(self, ids):
+        """Give up this worker's leases on ids so other workers can claim them right away"""
+        if not ids:
+            return
+        try:
+            self.cur.execute("""
+                UPDATE articles
+                SET lease_owner = NULL, lease_expires = NULL
+                WHERE id = ANY(%s) AND lease_owner = %s
+            """, (list(ids), self.worker_id))
+            self.dbconn.commit()
+        except Exception:
+            self.dbconn.rollback()
+            raise
+
+    def iter_batches(self, batch_size, limit=None):
+        """Claim and yield batches until the frontier is empty or limit rows were claimed"""
+        n_claimed = 0
+        while limit is None or n_claimed < limit:
+            n = batch_size if limit is None else min(batch_size, limit - n_claimed)
+            rows = self.claim(n)
+            if not rows:
+                break
+            n_claimed += len(rows)
+            yield rows
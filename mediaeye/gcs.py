@@ -1,20 +1,115 @@
 """Module providing an interface to the GCS"""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from .py_config import GCS_DATA
 
+GCS_URL = "https://customsearch.googleapis.com/customsearch/v1"
+DEFAULT_CACHE_PATH = "gcs_cache.json"
+# Custom Search allows 100 queries per minute per user
+DEFAULT_RATE = 100 / 60
+MAX_RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# New responses are written to disk at most this often, so a crash loses at most this many seconds
+CACHE_SAVE_INTERVAL = 10
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` acquisitions per second on average
+    and bursts of up to `capacity`.
+    """
+    def __init__(self, rate, capacity=1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 class GCS:
-    """A class for making requests to the Google Custom Search API"""
-    def __init__(self) -> None:
-        self.url = "https://customsearch.googleapis.com/customsearch/v1"
-        self.params = {
+    """
+    A class for making requests to the Google Custom Search API.
+
+    Requests share one pooled session and a token bucket, and successful responses are
+    cached on disk by query, so repeated queries cost no quota. The cache is saved at most
+    every CACHE_SAVE_INTERVAL seconds as responses arrive, and on `close` or leaving a with
+    block. `url` can point at a stub server.
+    """
+    def __init__(self, url=GCS_URL, cache_path=DEFAULT_CACHE_PATH, rate=DEFAULT_RATE,
+                 max_workers=4, params=None) -> None:
+        self.url = url
+        self.params = params if params is not None else {
             key: GCS_DATA[key]
             for key in ['key','cx','safe','lr']
         }
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(rate)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache_path = cache_path
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.last_save = time.monotonic()
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as f:
+                self.cache = json.load(f)
+
+    @staticmethod
+    def _cache_key(q, num):
+        return f"{num}|{q}"
+
+    def save_cache(self):
+        """Write the response cache to disk"""
+        if not self.cache_path:
+            return
+        with self.save_lock:
+            with self.cache_lock:
+                data = json.dumps(self.cache)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.cache_path)
+            self.last_save = time.monotonic()
+
+    def _save_cache_if_due(self):
+        """Save the cache if the last save is over CACHE_SAVE_INTERVAL seconds old"""
+        if time.monotonic() - self.last_save >= CACHE_SAVE_INTERVAL:
+            self.save_cache()
+
+    def close(self):
+        """Save the cache and close the session"""
+        self.save_cache()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def make_request(self, q, num):
         """
-        Make a request to the Google Custom Search API.
+        Make a request to the Google Custom Search API, or return the cached response.
 
         Args:
             q (str): The search query.
@@ -23,23 +118,61 @@ class GCS:
         Returns:
             dict: The API response data.
         """
-        self.params.update({
-            "q": q,
-            "num": num,
-        })
-        response = requests.get(self.url, params=self.params, timeout=120)
-        if response.status_code == 200:
-            data = response.json()
-            return data
-        print("Request failed with status code:", response.status_code)
+        key = self._cache_key(q, num)
+        with self.cache_lock:
+            if key in self.cache:
+                return self.cache[key]
+        params = {**self.params, "q": q, "num": num}
+        for attempt in range(MAX_RETRIES + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.get(self.url, params=params, timeout=120)
+            except requests.RequestException as e:
+                print(f"Request for {q!r} failed: {e}")
+                response = None
+            if response is not None and response.status_code == 200:
+                data = response.json()
+                with self.cache_lock:
+                    self.cache[key] = data
+                self._save_cache_if_due()
+                return data
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                break
+            if attempt < MAX_RETRIES:
+                time.sleep(2 ** attempt)
+        print("Request failed with status code:",
+              response.status_code if response is not None else None)
         return None
 
-    def school_and_newspaper_to_link(self, school, newspaper):
-        """Get the top link for a given school newspaper combo"""
-        q = f"{school} {newspaper} newspaper"
-        data = self.make_request(q, GCS_DATA['num_newspaper_results'])
+    def iter_search(self, queries, num):
+        """Run queries concurrently, yielding (query, data) as each completes"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.make_request, q, num): q for q in dict.fromkeys(queries)}
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                self.save_cache()
+
+    def search_many(self, queries, num):
+        """Run queries concurrently and return a dict of query to data"""
+        return dict(self.iter_search(queries, num))
+
+    @staticmethod
+    def newspaper_query(school, newspaper):
+        """Query used to find a school newspaper's site"""
+        return f"{school} {newspaper} newspaper"
+
+    @staticmethod
+    def top_link(data):
+        """First result link of a response, or None"""
         if data:
             newspapers = data.get('items', [])
-            link = newspapers[0]['link']
-            return link
-        return None
\ No newline at end of file
+            if newspapers:
+                return newspapers[0]['link']
+        return None
+
+    def school_and_newspaper_to_link(self, school, newspaper):
+        """Get the top link for a given school newspaper combo"""
+        q = self.newspaper_query(school, newspaper)
+        return self.top_link(self.make_request(q, GCS_DATA['num_newspaper_results']))
@@ -0,0 +1,112 @@
+"""Module providing indexed fuzzy matching of school names."""
+import re
+
+# "state" is kept distinctive, as it tells e.g. Ohio State University from Ohio University
+COMMON_WORDS = {"university", "college", "of", "the", "community", "at", "and"}
+# Candidates scoring below this are not offered at all
+MIN_CANDIDATE_SCORE = 0.2
+
+def normalize(name: str) -> str:
+    """Lowercase a name and reduce punctuation to single spaces"""
+    name = name.lower().replace("&", " and ")
+    return " ".join(re.sub(r"[^\w\s]", " ", name).split())
+
+def tokens(name: str) -> set:
+    """Distinctive words of a name, or all its words if it only has common ones"""
+    words = normalize(name).split()
+    distinctive = {word for word in words if word not in COMMON_WORDS}
+    return distinctive or set(words)
+
+def trigrams(name: str) -> set:
+    """Character trigrams of a name's distinctive words, padded at word boundaries"""
+    text = f"  {' '.join(sorted(tokens(name)))} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class NameMatcher:
+    """
+    Inverted token and character-trigram indexes over a set of names.
+
+    Candidates for a query are the names sharing a distinctive word with it, or failing
+    that a trigram, scored by the mean of their token and trigram Jaccard similarities.
+    """
+    def __init__(self, names=()) -> None:
+        self.names = set()
+        self.name_tokens = {}
+        self.name_trigrams = {}
+        self.name_words = {}
+        self.token_index = {}
+        self.trigram_index = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name) -> bool:
+        return name in self.names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name):
+        """Index a name"""
+        if name in self.names:
+            return
+        self.names.add(name)
+        self.name_tokens[name] = tokens(name)
+        self.name_trigrams[name] = trigrams(name)
+        self.name_words[name] = set(normalize(name).split())
+        for token in self.name_tokens[name]:
+            self.token_index.setdefault(token, set()).add(name)
+        for trigram in self.name_trigrams[name]:
+            self.trigram_index.setdefault(trigram, set()).add(name)
+
+    def remove(self, name):
+        """Stop offering a name, e.g. once it is paired"""
+        if name not in self.names:
+            return
+        self.names.remove(name)
+        self.name_words.pop(name)
+        for token in self.name_tokens.pop(name):
+            self.token_index[token].discard(name)
+        for trigram in self.name_trigrams.pop(name):
+            self.trigram_index[trigram].discard(name)
+
+    def candidates(self, query, limit=10, min_score=MIN_CANDIDATE_SCORE):
+        """
+        Names similar to query, best first.
+
+        Returns:
+            list: (name, score) pairs with scores in [0, 1], 1 for the same normalized name.
+        """
+        query_tokens = tokens(query)
+        query_trigrams = trigrams(query)
+        query_words = set(normalize(query).split())
+        pool = set()
+        for token in query_tokens:
+            pool.update(self.token_index.get(token, ()))
+        if not pool:
+            # No shared word, e.g. a misspelling: fall back to shared trigrams
+            for trigram in query_trigrams:
+                pool.update(self.trigram_index.get(trigram, ()))
+        scored = []
+        for name in pool:
+            name_tokens = self.name_tokens[name]
+            name_trigrams = self.name_trigrams[name]
+            name_words = self.name_words[name]
+            token_score = len(query_tokens & name_tokens) / len(query_tokens | name_tokens)
+            trigram_score = len(query_trigrams & name_trigrams) / len(query_trigrams | name_trigrams)
+            # Common words only separate otherwise equal names, e.g. X College and X University
+            word_score = len(query_words & name_words) / len(query_words | name_words)
+            score = (token_score + trigram_score) / 2 * (0.9 + 0.1 * word_score)
+            if score >= min_score:
+                scored.append((name, score))
+        scored.sort(key=lambda pair: (-pair[1], pair[0]))
+        return scored[:limit]
+
+    def confident_match(self, query, candidates):
+        """
+        The one candidate with the same words as query, ignoring order and punctuation,
+        or None. Near misses such as "Miami University" for "University of Miami" are
+        left to be confirmed by hand.
+        """
+        query_words = set(normalize(query).split())
+        matches = [name for name, _ in candidates if self.name_words[name] == query_words]
+        return matches[0] if len(matches) == 1 else None
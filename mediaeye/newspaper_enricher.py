@@ -1,40 +1,37 @@
 """Module containing functions that enrich the data in newspapers table"""
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
-from time import sleep
+import itertools
+from queue import Queue
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlparse
 from xml.etree.ElementTree import ParseError
-from advertools import url_to_df
 import pandas as pd
 from psycopg2.extras import execute_values
 from tqdm.auto import tqdm
-import requests
 from mediaeye.postgres import DBConn
+from mediaeye.bloom import DEFAULT_BLOOM_PATH, load_known_links
+from mediaeye.fetch_cache import FetchCache
 from mediaeye.gcs import GCS
-from mediaeye.sitemaps import sitemap_to_df
-from mediaeye.py_config import BW_API_KEY
+from mediaeye.pipeline_stats import PipelineStats
+from mediaeye.sitemaps import iter_sitemap
+from mediaeye.urls import url_dirs
+from mediaeye.wordpress import WordPressDetector
+from mediaeye.py_config import GCS_DATA
 
 GCS_SLEEP_DUR = 0.6
 
 class NewspaperEnricher:
     """Class that enriches newspapers table with automatic and manual data"""
     def __init__(self) -> None:
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
-        self.gcs = GCS()
+        # Queries run concurrently, at most one per GCS_SLEEP_DUR
+        self.gcs = GCS(rate=1 / GCS_SLEEP_DUR)
+        self.fetch_cache = FetchCache(self.dbconn)
+        self.stats = PipelineStats(self.cur)
+        self.dbconn.commit()
 
-    @staticmethod
-    def _is_wordpress(response):
-        """
-        Returns a boolean result saying if the response of the BW api denotes a given site is a WP site.
-        """
-        groups = response.json().get('groups')
-        if groups is None: 
-            return False
-        return any(group['name'] in ['widgets', 'framework', 'hosting'] and
-            any(category['name'] in ['wordpress-plugins', 'wordpress-theme', 'wordpress-hosting']
-                for category in group['categories']) for group in groups)
-    
     @staticmethod
     def _get_base_url(url):
         """Given a url, return the base url using urllib"""
@@ -43,27 +40,37 @@ class NewspaperEnricher:
         return base_url
 
     @staticmethod
-    def _get_article_urls(url, time_last_scraped):
+    def _get_article_urls(url, time_last_scraped, cache=None, cache_owner=None, max_workers=8):
         """
-        For a given newspaper url and time last scraped, find all possible article urls
+        For a given newspaper url and time last scraped, yield all possible article urls
+        as DataFrame chunks with their url_dirs, so a newspaper is never held in memory whole.
+        With a FetchCache, sitemaps unchanged since the last run are skipped.
+        At most max_workers of the newspaper's sitemaps are fetched at once.
         """
         base_url = NewspaperEnricher._get_base_url(url)
+        chunks = iter_sitemap(base_url + "robots.txt", max_workers=max_workers,
+                              last_scraped=time_last_scraped, cache=cache,
+                              cache_owner=cache_owner)
         try:
-            sitemap_df = sitemap_to_df(base_url + "robots.txt", last_scraped=time_last_scraped)
+            first_chunk = next(chunks, None)
         except (ValueError, HTTPError, URLError, ParseError):
+            chunks = iter_sitemap(base_url + "sitemap.xml", max_workers=max_workers,
+                                  last_scraped=time_last_scraped, cache=cache,
+                                  cache_owner=cache_owner)
             try:
-                sitemap_df = sitemap_to_df(base_url + "sitemap.xml", last_scraped=time_last_scraped)
-                if sitemap_df is None:
-                    return None
+                first_chunk = next(chunks, None)
             except (ValueError, HTTPError, URLError, ParseError) as e:
                 print("Exception occurred in get_sitemaps: ",e)
-                return None
-        if not 'loc' in sitemap_df.columns:
-            return None
-        sitemap_df = sitemap_df.dropna(subset=['loc'])
-        url_df = url_to_df(sitemap_df['loc'])
-        merged_df = pd.merge(sitemap_df, url_df, left_on='loc', right_on='url', how='inner')
-        return merged_df
+                return
+        if first_chunk is None:
+            return
+        for sitemap_df in itertools.chain([first_chunk], chunks):
+            if not 'loc' in sitemap_df.columns:
+                continue
+            sitemap_df = sitemap_df.dropna(subset=['loc']).reset_index(drop=True)
+            if sitemap_df.empty:
+                continue
+            yield pd.concat([sitemap_df, url_dirs(sitemap_df['loc'])], axis=1)
 
     def insert_links(self, n=None):
         """Insert up to n links for schools that do not have a link attribute."""
@@ -77,28 +84,33 @@ class NewspaperEnricher:
         newspapers = self.cur.fetchall()
         if n is not None:
             newspapers = newspapers[:n]
-        for row in tqdm(newspapers):
+        rows_by_query = {}
+        for row in newspapers:
             # row entries in order are n.id, n.name, s.name
-            link = self.gcs.school_and_newspaper_to_link(row[1], row[2])
-            # sleep to not overuse api
-            sleep(GCS_SLEEP_DUR)
-            if link:
-                today = date.today()
-                try:
-
-                    self.cur.execute("""
-                        UPDATE newspapers
-                        SET link = %s, date_link_scraped = %s
-                        WHERE id = %s
-                    """, (link, today, row[0]))
+            rows_by_query.setdefault(self.gcs.newspaper_query(row[1], row[2]), []).append(row)
+        results = self.gcs.iter_search(rows_by_query, GCS_DATA['num_newspaper_results'])
+        for q, data in tqdm(results, total=len(rows_by_query)):
+            link = self.gcs.top_link(data)
+            for row in rows_by_query[q]:
+                self._set_link(row, link)
 
-                    self.dbconn.commit()
-                    print(f"{row[1]} {row[2]} added link {link}")
-                except Exception as e:
-                    self.dbconn.rollback()
-                    print(f"An error occurred: {e}")
-            else:
-                print(f"{row[1]} {row[2]} not fetching GCS results.")
+    def _set_link(self, row, link):
+        """Store the link found for a (n.id, n.name, s.name) row"""
+        if link:
+            today = date.today()
+            try:
+                self.cur.execute("""
+                    UPDATE newspapers
+                    SET link = %s, date_link_scraped = %s
+                    WHERE id = %s
+                """, (link, today, row[0]))
+                self.dbconn.commit()
+                print(f"{row[1]} {row[2]} added link {link}")
+            except Exception as e:
+                self.dbconn.rollback()
+                print(f"An error occurred: {e}")
+        else:
+            print(f"{row[1]} {row[2]} not fetching GCS results.")
 
     def verify_links(self):
         """Manually verify that given links match up for schools and newspapers"""
@@ -133,12 +145,15 @@ class NewspaperEnricher:
                 self.dbconn.rollback()
                 print(f"An error occurred: {e}")
 
-    def set_wordpress_status(self, n=None):
+    def set_wordpress_status(self, n=None, max_workers=32, batch_size=500):
         """
-        Use the builtwith api to determine if a given newspaper is written in wordpress
+        Fingerprint newspaper homepages concurrently to determine if they are written in wordpress.
+        Results are written in batches; unreachable sites are left NULL to be retried.
 
         Arguments:
         n: number of newspapers
+        max_workers: number of homepages fetched at once
+        batch_size: number of results per UPDATE
         """
         self.cur.execute("""
             SELECT id, link
@@ -149,28 +164,49 @@ class NewspaperEnricher:
         newspapers = self.cur.fetchall()
         if n is not None:
             newspapers = newspapers[:n]
-        for row in tqdm(newspapers):
-            try:
-                r = requests.get("https://api.builtwith.com/free1/api.json", 
-                                 params={"KEY":BW_API_KEY, "LOOKUP":row[1]}, timeout=5)
-                wordpress = self._is_wordpress(r)
-                self.cur.execute("""
-                    UPDATE newspapers
-                    SET is_wordpress = %s
-                    WHERE id = %s
-                """, (wordpress, row[0]))
+        ids_by_link = {}
+        for newspaper_id, link in newspapers:
+            ids_by_link.setdefault(link, []).append(newspaper_id)
+        detector = WordPressDetector(max_workers=max_workers)
+        results = []
+        for link, wordpress in tqdm(detector.detect_many(ids_by_link), total=len(ids_by_link)):
+            if wordpress is not None:
+                results.extend((newspaper_id, wordpress) for newspaper_id in ids_by_link[link])
+            if len(results) >= batch_size:
+                self._update_wordpress_status(results)
+                results = []
+        self._update_wordpress_status(results)
 
-                self.dbconn.commit()
-                print(f"{row[1]} wordpress status set")
-            except Exception as e:
-                self.dbconn.rollback()
-                print(f"An error occurred: {e}")
-            sleep(1)
+    def _update_wordpress_status(self, results):
+        """Write (id, is_wordpress) pairs"""
+        if not results:
+            return
+        try:
+            execute_values(self.cur, """
+                UPDATE newspapers AS n
+                SET is_wordpress = v.is_wordpress
+                FROM (VALUES %s) AS v(id, is_wordpress)
+                WHERE n.id = v.id
+            """, results)
+            self.dbconn.commit()
+            print(f"wordpress status set for {len(results)} newspapers")
+        except Exception as e:
+            self.dbconn.rollback()
+            print(f"An error occurred: {e}")
 
-    def insert_article_urls(self, n=None, start_index=0, wordpress_only=True):
+    def insert_article_urls(self, n=None, start_index=0, wordpress_only=True, bloom_path=DEFAULT_BLOOM_PATH,
+                            workers=1, domain_workers=1):
         """
-        For first n newspapers, get all urls and insert them to the db
+        For first n newspapers, get all urls and insert them to the db.
+        Links already in articles are screened out with the Bloom filter saved at bloom_path.
+        With workers > 1, sitemaps of that many domains are fetched at once, one worker per
+        domain, while this thread writes each newspaper's links as they arrive. Each worker
+        fetches at most domain_workers of its domain's sitemaps at once, so at most
+        workers * domain_workers requests are in flight.
         """
+        known_links = load_known_links(self.dbconn, bloom_path)
+        print(f"Loaded {len(known_links)} known links, " +
+              f"false positive rate {known_links.false_positive_rate():.2e}")
         if wordpress_only:
             self.cur.execute("""
                 SELECT id, school_id, link, time_last_scraped
@@ -189,38 +225,129 @@ class NewspaperEnricher:
             newspapers = newspapers[start_index:]
         if n is not None:
             newspapers = newspapers[:n]
-        for row in tqdm(newspapers):
-            now = datetime.now()
-            print(f"{row[2]} last scraped {row[3]} being scraped.")
-            article_df = self._get_article_urls(row[2], row[3])
-            if article_df is not None:
+        if workers > 1:
+            rows_by_domain = {}
+            for row in newspapers:
+                domain = urlparse(row[2]).netloc.lower().removeprefix("www.")
+                rows_by_domain.setdefault(domain, []).append(row)
+            # Bounded so workers wait rather than pile up chunks this thread has not written
+            results = Queue(maxsize=workers * 2)
+            runs = {}
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._fetch_article_urls, rows, results, domain_workers)
+                           for rows in rows_by_domain.values()]
+                with tqdm(total=len(newspapers)) as progress:
+                    while progress.n < len(newspapers):
+                        kind, row, value = results.get()
+                        run = runs.setdefault(row[0], self._new_run())
+                        if kind == "chunk":
+                            self._store_article_chunk(run, row, value, known_links)
+                            continue
+                        self._finish_article_urls(run, row, *value)
+                        del runs[row[0]]
+                        progress.update()
+                for future in futures:
+                    future.result()
+        else:
+            for row in tqdm(newspapers):
+                now = datetime.now()
+                print(f"{row[2]} last scraped {row[3]} being scraped.")
+                run = self._new_run()
+                error = None
                 try:
-                    for col in ['lastmod','dir_2','dir_3','dir_4','dir_5']:
-                        if col not in article_df.columns:
-                            article_df[col] = None
-                    article_df['lastmod'] = article_df['lastmod'].replace({pd.NaT: None})
-                    article_df = article_df.drop_duplicates(subset='url', keep='first')
-                    subset_article_df = article_df[['url','lastmod','sitemap','dir_1','dir_2','dir_3','dir_4','dir_5','last_dir']]
-                    article_tuples = list(subset_article_df.itertuples(index=False))
-                    enriched_article_tuples = [(row[1], row[0], *t) for t in article_tuples]
-                    execute_values(self.cur, """
-                        INSERT INTO articles
-                        (school_id, newspaper_id, link, lastmod, origin_link, dir_1, dir_2, dir_3, dir_4, dir_5, last_dir)
-                        VALUES %s
-                        ON CONFLICT (link) DO NOTHING                        
-                    """, enriched_article_tuples)
-                    self.cur.execute("""
-                        UPDATE newspapers
-                        SET time_last_scraped = %s
-                        WHERE id = %s
-                    """, (now, row[0]))
-                    self.dbconn.commit()
-                    print(f"{len(enriched_article_tuples)} links added for {row[2]}")
+                    for article_df in self._get_article_urls(row[2], row[3], self.fetch_cache, row[0]):
+                        self._store_article_chunk(run, row, article_df, known_links)
                 except Exception as e:
-                    self.dbconn.rollback()
-                    print(f"An error occurred: {e}")
+                    error = e
+                self._finish_article_urls(run, row, now, error)
+        try:
+            self.stats.write()
+            self.dbconn.commit()
+        except Exception as e:
+            self.dbconn.rollback()
+            print(f"An error occurred writing pipeline stats: {e}")
+        known_links.save(bloom_path)
+        print(f"Saved {len(known_links)} known links to {bloom_path}, " +
+              f"false positive rate {known_links.false_positive_rate():.2e}")
 
-            
+    def _fetch_article_urls(self, rows, results, max_workers):
+        """
+        Get article urls for newspapers in turn, putting ("chunk", row, article_df) on results
+        for each chunk, then ("done", row, (now, error)).
+        """
+        for row in rows:
+            now = datetime.now()
+            print(f"{row[2]} last scraped {row[3]} being scraped.")
+            try:
+                for article_df in self._get_article_urls(row[2], row[3], self.fetch_cache, row[0],
+                                                         max_workers):
+                    results.put(("chunk", row, article_df))
+                results.put(("done", row, (now, None)))
+            except Exception as e:
+                results.put(("done", row, (now, e)))
 
+    @staticmethod
+    def _new_run():
+        """Progress of storing one newspaper's article urls"""
+        return {'failed': False, 'n_chunks': 0, 'n_links': 0, 'n_screened': 0}
 
+    def _store_article_chunk(self, run, row, article_df, known_links):
+        """Insert a chunk of a newspaper's new article urls in its own transaction"""
+        if run['failed']:
+            return
+        try:
+            article_df['lastmod'] = article_df['lastmod'].replace({pd.NaT: None})
+            article_df = article_df.drop_duplicates(subset='loc', keep='first')
+            is_new = [loc not in known_links for loc in article_df['loc']]
+            n_screened = len(is_new) - sum(is_new)
+            article_df = article_df[is_new]
+            subset_article_df = article_df[['loc','lastmod','sitemap','dir_1','dir_2','dir_3','dir_4','dir_5','last_dir']]
+            article_tuples = list(subset_article_df.itertuples(index=False))
+            enriched_article_tuples = [(row[1], row[0], *t) for t in article_tuples]
+            inserted = []
+            if enriched_article_tuples:
+                inserted = execute_values(self.cur, """
+                    INSERT INTO articles
+                    (school_id, newspaper_id, link, lastmod, origin_link, dir_1, dir_2, dir_3, dir_4, dir_5, last_dir)
+                    VALUES %s
+                    ON CONFLICT (link) DO NOTHING
+                    RETURNING id
+                """, enriched_article_tuples, fetch=True)
+            self.dbconn.commit()
+            self.stats.add({'links': len(inserted)})
+            known_links.update(article_df['loc'])
+            run['n_chunks'] += 1
+            run['n_links'] += len(enriched_article_tuples)
+            run['n_screened'] += n_screened
+        except Exception as e:
+            self.dbconn.rollback()
+            # Fetch these sitemaps again next run rather than skipping them
+            self.fetch_cache.discard(row[0])
+            run['failed'] = True
+            print(f"An error occurred: {e}")
 
+    def _finish_article_urls(self, run, row, now, error):
+        """Once all of a newspaper's chunks are stored, set its time_last_scraped to now
+        and keep its skipped sitemaps cached"""
+        if error is not None:
+            self.fetch_cache.discard(row[0])
+            print(f"An error occurred getting urls for {row[2]}: {error}")
+            return
+        if run['failed']:
+            return
+        try:
+            if run['n_chunks']:
+                self.cur.execute("""
+                    UPDATE newspapers
+                    SET time_last_scraped = %s
+                    WHERE id = %s
+                """, (now, row[0]))
+            self.fetch_cache.flush(row[0])
+            self.dbconn.commit()
+            if run['n_chunks']:
+                print(f"{run['n_links']} links added for {row[2]}, " +
+                      f"{run['n_screened']} known links skipped")
+        except Exception as e:
+            self.dbconn.rollback()
+            self.fetch_cache.discard(row[0])
+            print(f"An error occurred: {e}")
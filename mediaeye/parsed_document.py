@@ -0,0 +1,128 @@
+"""Module providing parsed views of article pages for the extractors to share."""
+
+from abc import ABC, abstractmethod
+from functools import cached_property
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml.etree import ParserError
+except ImportError:
+    lxml = None
+
+DEFAULT_BACKEND = 'lxml'
+
+class ParsedDocument(ABC):
+    """
+    A page parsed once, exposing everything the extractors read.
+
+    Each view (text, meta tags, title, paragraphs) is computed on first access and cached,
+    so several extractors reading the same field do not re-walk or re-serialize the tree.
+    `html` is the markup as downloaded. Backends implement every view, as cached properties.
+    """
+    def __init__(self, html: str) -> None:
+        self.html = html
+
+    @property
+    @abstractmethod
+    def text(self):
+        """All text in the document"""
+
+    @property
+    @abstractmethod
+    def meta(self):
+        """Dict of meta tag name to content, keeping the first tag for each name"""
+
+    @property
+    @abstractmethod
+    def title(self):
+        """Text of the title tag, or None"""
+
+    @property
+    @abstractmethod
+    def paragraphs(self):
+        """List of stripped text of each <p> tag"""
+
+class SoupDocument(ParsedDocument):
+    """BeautifulSoup backed document, using lxml as the tree builder when available"""
+    def __init__(self, html: str, parser=None) -> None:
+        super().__init__(html)
+        self.parser = parser or ('lxml' if lxml else 'html.parser')
+
+    @cached_property
+    def soup(self):
+        """The BeautifulSoup tree"""
+        return BeautifulSoup(self.html, self.parser)
+
+    @cached_property
+    def text(self):
+        return self.soup.get_text()
+
+    @cached_property
+    def meta(self):
+        meta = {}
+        for tag in self.soup.find_all('meta', attrs={'name': True}):
+            meta.setdefault(tag.get('name'), tag.get('content'))
+        return meta
+
+    @cached_property
+    def title(self):
+        title_tag = self.soup.find('title')
+        return title_tag.text if title_tag else None
+
+    @cached_property
+    def paragraphs(self):
+        return [tag.get_text().strip() for tag in self.soup.find_all('p')]
+
+class LxmlDocument(ParsedDocument):
+    """lxml.html backed document, skipping BeautifulSoup entirely"""
+    @cached_property
+    def root(self):
+        """The lxml root element, or None for empty or unparseable pages"""
+        html = self.html
+        if html.lstrip().startswith('<?xml'):
+            # lxml refuses str input carrying an XML encoding declaration
+            html = html.encode('utf-8')
+        try:
+            return lxml.html.document_fromstring(html)
+        except (ParserError, ValueError):
+            return None
+
+    @cached_property
+    def text(self):
+        return self.root.text_content() if self.root is not None else ''
+
+    @cached_property
+    def meta(self):
+        meta = {}
+        if self.root is not None:
+            for tag in self.root.iter('meta'):
+                name = tag.get('name')
+                if name is not None:
+                    meta.setdefault(name, tag.get('content'))
+        return meta
+
+    @cached_property
+    def title(self):
+        if self.root is None:
+            return None
+        title_tag = next(self.root.iter('title'), None)
+        return title_tag.text_content() if title_tag is not None else None
+
+    @cached_property
+    def paragraphs(self):
+        if self.root is None:
+            return []
+        return [tag.text_content().strip() for tag in self.root.iter('p')]
+
+BACKENDS = {
+    'lxml': LxmlDocument,
+    'soup': SoupDocument,
+}
+
+def parse_document(html: str, backend=None) -> ParsedDocument:
+    """Parse a page with the given backend, falling back to BeautifulSoup without lxml"""
+    backend = backend or DEFAULT_BACKEND
+    if backend == 'lxml' and lxml is None:
+        backend = 'soup'
+    return BACKENDS[backend](html)
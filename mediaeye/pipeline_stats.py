@@ -0,0 +1,150 @@
+"""Module for the DB counts reported by db_info_logger, scanned or kept in pipeline_stats."""
+from datetime import datetime
+from psycopg2.extras import execute_values
+
+# Counted stats per table, as stat name to filter condition (None counts every row).
+# Conditions are run through psycopg2's formatting, so literal % is written %%.
+TABLE_STATS = {
+    'schools': {
+        'schools': None,
+        'amcha_entries': "amcha_name IS NOT NULL",
+        'wiki_entries': "name IS NOT NULL",
+        'joint_entries': "name IS NOT NULL AND amcha_name IS NOT NULL",
+    },
+    'newspapers': {
+        'link_entries': "link IS NOT NULL",
+        'inspected_entries': "link_is_accurate IS NOT NULL",
+        'accurate_entries': "link_is_accurate IS TRUE",
+        'wordpress_entries': "link_is_accurate IS TRUE AND is_wordpress IS TRUE",
+    },
+    'incidents': {
+        'incidents': None,
+        'physical_assault_incidents': "physical_assault IS TRUE",
+    },
+    'articles': {
+        'links': None,
+        'nonarticle_links': "filter_status != 'article' AND is_filtered IS TRUE",
+        'article_links': "filter_status = 'article' AND is_filtered IS TRUE",
+        'content_articles': "content IS NOT NULL OR content_hash IS NOT NULL",
+        'israel_articles': "title ILIKE '%%Israel%%'",
+    },
+}
+# Stats of the articles table, kept up to date by the article pipelines
+CONTENT_STATS = ['content_articles', 'israel_articles']
+FILTER_STATS = ['nonarticle_links', 'article_links']
+
+def scan_counts(cur, table, names=None, where=None, params=()) -> dict:
+    """
+    Count a table's stats in a single scan with COUNT(*) FILTER.
+
+    Args:
+        names (list): Stats to count, all of the table's by default.
+        where (str): Condition restricting the rows counted.
+    """
+    stats = TABLE_STATS[table]
+    names = list(names or stats)
+    columns = ', '.join(f"COUNT(*) FILTER (WHERE {stats[name]})" if stats[name] else "COUNT(*)"
+                        for name in names)
+    query = f"SELECT {columns} FROM {table}"
+    if where:
+        query += f" WHERE {where}"
+    cur.execute(query, params)
+    return dict(zip(names, cur.fetchone()))
+
+def stat_deltas_query(table, names, rows_condition, update):
+    """
+    Wrap an UPDATE of table so it also returns how it changes stats, in the same round trip.
+
+    The stats of the rows matching rows_condition are evaluated before the update in a CTE,
+    and again on the rows the update returns, so the statement yields one row of
+    (rows updated, *delta per stat).
+
+    Args:
+        rows_condition (str): Condition on table matching the rows the update changes.
+        update (str): The UPDATE, ending in RETURNING of all of the table's columns.
+    """
+    stats = TABLE_STATS[table]
+    flags = {name: f"COALESCE(({stats[name] or 'TRUE'})::int, 0)" for name in names}
+    old_columns = ', '.join(f"{flag} AS {name}" for name, flag in flags.items())
+    deltas = ', '.join(f"(SELECT COALESCE(SUM({flag}), 0) FROM updated)"
+                       f" - (SELECT COALESCE(SUM({name}), 0) FROM old)"
+                       for name, flag in flags.items())
+    return f"""
+        WITH old AS (
+            SELECT {old_columns} FROM {table} WHERE {rows_condition} FOR UPDATE
+        ),
+        updated AS (
+            {update}
+        )
+        SELECT (SELECT COUNT(*) FROM updated), {deltas}
+    """
+
+class PipelineStats:
+    """
+    Counters in the optional pipeline_stats table, so reports need not scan articles.
+
+    `refresh` sets them from a scan. Pipelines `add` the deltas of their committed writes
+    in memory and `write` them once per flush or at close, so concurrent writers only
+    hold the counter rows briefly. Counters lag by deltas not yet written, and those of a
+    process that dies are lost until the next refresh. Without the table, every method
+    is a no-op.
+    """
+    def __init__(self, cur) -> None:
+        self.cur = cur
+        self.cur.execute("SELECT to_regclass('pipeline_stats') IS NOT NULL")
+        self.enabled = self.cur.fetchone()[0]
+        self.pending = {}
+
+    def increment(self, deltas: dict):
+        """Add deltas to their counters now. Does not commit."""
+        deltas = {name: delta for name, delta in deltas.items() if delta}
+        if not self.enabled or not deltas:
+            return
+        now = datetime.now()
+        execute_values(self.cur, """
+            INSERT INTO pipeline_stats (name, value, time_updated)
+            VALUES %s
+            ON CONFLICT (name) DO UPDATE
+            SET value = pipeline_stats.value + EXCLUDED.value, time_updated = EXCLUDED.time_updated
+        """, [(name, delta, now) for name, delta in deltas.items()])
+
+    def add(self, deltas: dict):
+        """Accumulate deltas of committed writes, to be written by `write`"""
+        if not self.enabled:
+            return
+        for name, delta in deltas.items():
+            self.pending[name] = self.pending.get(name, 0) + delta
+
+    def write(self):
+        """Add accumulated deltas to their counters. Does not commit."""
+        deltas, self.pending = self.pending, {}
+        self.increment(deltas)
+
+    def read(self) -> dict:
+        """Counters as name to (value, time_updated)"""
+        if not self.enabled:
+            return {}
+        self.cur.execute("SELECT name, value, time_updated FROM pipeline_stats")
+        return {name: (value, time_updated) for name, value, time_updated in self.cur.fetchall()}
+
+    def refresh(self, table='articles', names=None):
+        """Set counters of a table from a scan. Does not commit."""
+        if not self.enabled:
+            return
+        counts = scan_counts(self.cur, table, names)
+        now = datetime.now()
+        execute_values(self.cur, """
+            INSERT INTO pipeline_stats (name, value, time_updated)
+            VALUES %s
+            ON CONFLICT (name) DO UPDATE
+            SET value = EXCLUDED.value, time_updated = EXCLUDED.time_updated
+        """, [(name, count, now) for name, count in counts.items()])
+
+    @staticmethod
+    def create(dbconn):
+        """Create pipeline_stats and fill it from a scan of articles"""
+        dbconn.create_table('pipeline_stats')
+        stats = PipelineStats(dbconn.cur)
+        stats.refresh()
+        dbconn.commit()
+        return stats
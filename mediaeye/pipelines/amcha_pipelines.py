@@ -1,20 +1,25 @@
 from datetime import date
 from collections import defaultdict
+from psycopg2.extras import execute_values
 from mediaeye.items import AmchaUniItem, IncidentItem
+from mediaeye.name_matcher import NameMatcher
 from mediaeye.postgres import DBConn
 
 class AmchaUniPipeline:
     """Takes in amcha university entries, looks at existing wikipedia university entries, 
-    and attempts to match them up."""
+    and attempts to match them up.
+
+    Unpaired wikipedia names are indexed by a NameMatcher. Names with the same words
+    are paired automatically; every other candidate is asked about."""
 
     def __init__(self) -> None:
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
         self.manual_verification_stop = False
         self.school_rows = None
         self.known_amcha_names = set()
         self.unpaired_schools = None
-
+        self.matcher = None
 
     def open_spider(self, spider) -> None:
         """Connect to DB on spider opening"""
@@ -24,9 +29,10 @@ class AmchaUniPipeline:
         """)
         self.school_rows = self.cur.fetchall()
         self.known_amcha_names.update((school_row[1] for school_row in self.school_rows))
-        self.known_amcha_names.remove(None)
-        self.unpaired_schools = [school_row[0] for school_row in self.school_rows
-                                 if school_row[1] is None]
+        self.known_amcha_names.discard(None)
+        self.unpaired_schools = {school_row[0] for school_row in self.school_rows
+                                 if school_row[1] is None and school_row[0] is not None}
+        self.matcher = NameMatcher(self.unpaired_schools)
 
     def close_spider(self, spider):
         """Close DB connection"""
@@ -46,22 +52,27 @@ class AmchaUniPipeline:
         if amcha_name in self.unpaired_schools:
             spider.logger.info(f"Exact match found for {amcha_name} found.")
             self.update_schools_db(spider, amcha_name, origin_link, school_name=amcha_name)
+            return
+        candidates = self.generate_rough_matches(spider, amcha_name)
+        school_name = self.matcher.confident_match(amcha_name, candidates)
+        if school_name is not None:
+            spider.logger.info(f"Same-word match {school_name} found for {amcha_name}.")
+            self.update_schools_db(spider, amcha_name, origin_link, school_name=school_name)
         elif self.manual_verification_stop:
             spider.logger.info(f"No exact match found for {amcha_name}." \
                                 " Left unmatched at verifier's request.")
         else:
-            self.process_rough_matches(spider, amcha_name, origin_link)
+            self.process_rough_matches(spider, amcha_name, origin_link, candidates)
 
-    def process_rough_matches(self, spider, amcha_name, origin_link):
-        """Attempt to find rough matches for an item"""
-        candidates = self.generate_rough_matches(spider, amcha_name)
+    def process_rough_matches(self, spider, amcha_name, origin_link, candidates):
+        """Ask for the best of an item's ranked rough matches"""
         if len(candidates) == 0:
             spider.logger.info(f"No rough matches found for {amcha_name}." \
                                 " Keeping unmatched.")
             self.update_schools_db(spider, amcha_name, origin_link, matched=False)
         else:
-            matches_list = "\n".join([f"{i}. {match}"
-                                        for i, match in enumerate(candidates, 1)])
+            matches_list = "\n".join([f"{i}. {match} ({score:.2f})"
+                                        for i, (match, score) in enumerate(candidates, 1)])
 
             spider.logger.info(f"\tRough matches for {amcha_name}:\n{matches_list}")
 
@@ -75,32 +86,17 @@ class AmchaUniPipeline:
             elif idx == 0:
                 self.update_schools_db(spider, amcha_name, origin_link, matched=False)
             elif 0 < idx <= len(candidates):
-                school_name = candidates[idx-1]
-                spider.logger.info(f"Closest match: {candidates[idx-1]}")
+                school_name = candidates[idx-1][0]
+                spider.logger.info(f"Closest match: {school_name}")
                 self.update_schools_db(spider, amcha_name, origin_link, school_name=school_name)
             else:
                 spider.logger.info("Invalid index.")
 
     def generate_rough_matches(self, spider, amcha_name):
         """Find university names in the wikipedia name base that roughly match the
-        amcha name. Current scheme gets individual words and filters out common ones,
-        then performing look up"""
+        amcha name, as (name, score) pairs ranked by the name matcher"""
         spider.logger.info(f"Attempting to find a rough match found for {amcha_name}:")
-        # Get words in name
-        words_in_amcha_name = amcha_name.replace(",","").split(" ")
-        common_words = ["University","College","of","the","Community", "State", "", " "]
-        # Strip and filter out common words
-        stripped_words = [word.strip() for word in words_in_amcha_name]
-        words_in_amcha_name = [word for word in stripped_words if word not in common_words]
-        spider.logger.info(f"Words in amcha name: {words_in_amcha_name}")
-        # If no words left, return no candidates
-        if len(words_in_amcha_name) == 0:
-            return []
-        # Otherwise return all candidates with at least one common word.
-        candidates = [school for school in self.unpaired_schools if
-                        any(word in school.split(" ") for word in words_in_amcha_name)]
-        return candidates
-
+        return self.matcher.candidates(amcha_name)
 
     def update_schools_db(self, spider, amcha_name, origin_link, school_name=None, matched=True):
         """Update the schools DB either by adding a new entry for unmatched data
@@ -115,7 +111,8 @@ class AmchaUniPipeline:
                 """, (amcha_name, origin_link, today, school_name))
                 self.dbconn.commit()
                 spider.logger.info("Updated schools for scraped name.")
-                self.unpaired_schools.remove(school_name)
+                self.unpaired_schools.discard(school_name)
+                self.matcher.remove(school_name)
             else:
                 self.cur.execute("""
                     INSERT INTO schools (amcha_name, amcha_origin_link, amcha_date_scraped, amcha_name_skipped)
@@ -129,8 +126,25 @@ class AmchaUniPipeline:
 
 
 class AmchaIncidentPipeline:
-    """Pipeline to take in amcha incident data and insert it into the DB"""
+    """Pipeline to take in amcha incident data and insert it into the DB.
+
+    Schools are resolved from a school_web_id/amcha_name cache loaded at spider open.
+    Incidents are buffered and inserted `batch_size` at a time, skipping amcha_web_ids
+    already stored, and each school's amcha_web_id is written at most once per run.
+    If a batch fails, its incidents are retried one by one."""
     total_count = 0
+    batch_size = 500
+    # Incident columns written, in order. Only those an incident has are listed in its
+    # INSERT, so absent fields keep their column defaults.
+    incident_columns = [
+        'school_id', 'origin_link', 'date_scraped', 'date_occurred', 'description',
+        'amcha_web_id', 'category_raw', 'classification_raw', 'school_web_id', 'school_name',
+        'photos_link', 'bds_vote_passed', 'school_response',
+        'targeting_jewish_students_and_staff', 'antisemitic_expression', 'physical_assault',
+        'discrimination', 'destruction_of_jewish_property', 'genocidal_expression',
+        'suppression_of_speech_movement_assembly', 'bullying', 'denigration', 'historical',
+        'condoning_terrorism', 'denying_jews_self_determination', 'demonization', 'bds_activity',
+    ]
     unassigned_field_examples = defaultdict(list)
 
     def to_db_col_name(self, option: str):
@@ -211,18 +225,53 @@ class AmchaIncidentPipeline:
         return mapped_fields
 
     def __init__(self) -> None:
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
+        self.school_ids_by_name = {}
+        self.school_ids_by_web_id = {}
+        self.school_web_ids = {}
+        self.pending_web_ids = {}
+        self.buffer = []
+        self.inserted_count = 0
+
+    def open_spider(self, spider) -> None:
+        """Cache the schools incidents can be matched to and read the batch size off the spider"""
+        self.batch_size = int(getattr(spider, 'batch_size', None) or self.batch_size)
+        self.cur.execute("""
+            SELECT id, amcha_name, amcha_web_id FROM schools
+            WHERE amcha_name IS NOT NULL OR amcha_web_id IS NOT NULL
+        """)
+        for school_id, amcha_name, amcha_web_id in self.cur.fetchall():
+            if amcha_name is not None:
+                self.school_ids_by_name.setdefault(amcha_name, school_id)
+            if amcha_web_id is not None:
+                self.school_ids_by_web_id.setdefault(amcha_web_id, school_id)
+            self.school_web_ids[school_id] = amcha_web_id
 
     def close_spider(self, spider) -> None:
-        """Close DB conn and log number of examples"""
+        """Flush buffered incidents, close DB conn and log number of examples"""
+        if self.buffer:
+            self.flush(spider)
         self.dbconn.close(commit=True)
-        spider.logger.info(f"\n\nTotal number of examples: {self.total_count}")
+        spider.logger.info(f"\n\nTotal number of examples: {self.total_count}, " +
+                           f"{self.inserted_count} new incidents inserted")
+
+    def resolve_school_id(self, school_web_id, school_name):
+        """School id for an incident's school, queueing its amcha_web_id to be written if new"""
+        school_id = self.school_ids_by_web_id.get(school_web_id)
+        if school_id is None:
+            school_id = self.school_ids_by_name.get(school_name)
+        if school_id is not None and school_web_id is not None \
+                and self.school_web_ids.get(school_id) != school_web_id:
+            self.pending_web_ids[school_id] = school_web_id
+            self.school_web_ids[school_id] = school_web_id
+            self.school_ids_by_web_id[school_web_id] = school_id
+        return school_id
 
     def process_item(self, item: IncidentItem, spider):
         """Process raw fields into DB columns, 
         attempt to get the school from schools DB associated,
-        and finally insert the incident into the incidents DB"""
+        and finally buffer the incident for insertion into the incidents DB"""
         today = date.today()
         mapped_dict = self.raw_fields_processor(item['raw_fields'])
         if 'school_web_id' not in mapped_dict:
@@ -233,27 +282,88 @@ class AmchaIncidentPipeline:
             'origin_link': item['origin_link'],
             'amcha_web_id': item['amcha_web_id'],
         })
-        try:
-            self.cur.execute("""
-                UPDATE schools
-                SET amcha_web_id = %s
-                WHERE amcha_name = %s
-                RETURNING id;
-            """, (mapped_dict['school_web_id'],mapped_dict['school_name']))
-            school_id = self.cur.fetchone()[0]
+        school_id = self.resolve_school_id(mapped_dict['school_web_id'], mapped_dict['school_name'])
+        if school_id is None:
+            spider.logger.warning(f"No school found for {mapped_dict['school_name']}," +
+                                  f" incident {mapped_dict['amcha_web_id']} skipped.")
+        else:
             mapped_dict['school_id'] = school_id
+            self.buffer.append(mapped_dict)
+            if len(self.buffer) >= self.batch_size:
+                self.flush(spider)
 
-            cols = ', '.join(mapped_dict.keys())
-            placeholders = ', '.join(['%s'] * len(mapped_dict))
-            sql = f"INSERT INTO incidents ({cols}) VALUES ({placeholders})"
-            self.cur.execute(sql, tuple(mapped_dict.values()))
+        self.total_count += 1
 
-            self.dbconn.commit()
+    def _row(self, mapped_dict):
+        """Columns an incident has, in incident_columns order, and its values for them"""
+        unknown = set(mapped_dict) - set(self.incident_columns)
+        if unknown:
+            raise ValueError(f"Incident fields with no column: {sorted(unknown)}")
+        cols = tuple(col for col in self.incident_columns if col in mapped_dict)
+        return cols, tuple(mapped_dict[col] for col in cols)
+
+    def _insert_incidents(self, cols, rows):
+        """Insert incidents sharing the same columns, returning the ids of new ones"""
+        return execute_values(self.cur, f"""
+            INSERT INTO incidents ({', '.join(cols)})
+            VALUES %s
+            ON CONFLICT (amcha_web_id) DO NOTHING
+            RETURNING id
+        """, rows, fetch=True)
 
-            spider.logger.info(f"Incident for {mapped_dict['school_name']}" +
-                               f" on {mapped_dict['date_occurred']} inserted.")
+    def _write_web_ids(self):
+        """Write pending school amcha_web_ids. Does not commit."""
+        if self.pending_web_ids:
+            execute_values(self.cur, """
+                UPDATE schools AS s
+                SET amcha_web_id = v.amcha_web_id
+                FROM (VALUES %s) AS v(id, amcha_web_id)
+                WHERE s.id = v.id
+            """, list(self.pending_web_ids.items()))
+
+    def _web_ids_failed(self):
+        """Write these schools' amcha_web_ids again with the next batch"""
+        for school_id in self.pending_web_ids:
+            self.school_web_ids.pop(school_id, None)
+        self.pending_web_ids = {}
+
+    def flush(self, spider):
+        """Write pending school amcha_web_ids and insert buffered incidents in one transaction"""
+        try:
+            rows_by_cols = defaultdict(list)
+            for mapped_dict in self.buffer:
+                cols, row = self._row(mapped_dict)
+                rows_by_cols[cols].append(row)
+            self._write_web_ids()
+            n_inserted = 0
+            for cols, rows in rows_by_cols.items():
+                n_inserted += len(self._insert_incidents(cols, rows))
+            self.dbconn.commit()
+            self.pending_web_ids = {}
+            self.inserted_count += n_inserted
+            spider.logger.info(f"{n_inserted}/{len(self.buffer)} incidents inserted.")
         except Exception as e:
-            print(f"An error occurred: {e}")
             self.dbconn.rollback()
+            spider.logger.error(f"Batch of {len(self.buffer)} incidents failed, writing one by one: {e}")
+            self.write_one_by_one(spider)
+        self.buffer = []
 
-        self.total_count += 1
\ No newline at end of file
+    def write_one_by_one(self, spider):
+        """Write pending amcha_web_ids, then each buffered incident in its own transaction"""
+        try:
+            self._write_web_ids()
+            self.dbconn.commit()
+            self.pending_web_ids = {}
+        except Exception as e:
+            self.dbconn.rollback()
+            self._web_ids_failed()
+            spider.logger.error(f"An error occurred writing school amcha_web_ids: {e}")
+        for mapped_dict in self.buffer:
+            try:
+                cols, row = self._row(mapped_dict)
+                self.inserted_count += len(self._insert_incidents(cols, [row]))
+                self.dbconn.commit()
+            except Exception as e:
+                self.dbconn.rollback()
+                spider.logger.error(f"An error occurred inserting incident" \
+                                    f" {mapped_dict['amcha_web_id']}: {e}")
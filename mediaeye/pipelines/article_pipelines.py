@@ -1,60 +1,226 @@
 from datetime import date, datetime
-from advertools import url_to_df
+import io
+import time
 import pandas as pd
 from psycopg2.extras import execute_values
+from mediaeye.bloom import DEFAULT_BLOOM_PATH, load_known_links
+from mediaeye.content_store import ContentStore
 from mediaeye.items import ArticleItem, ArticleInsertItem
+from mediaeye.pipeline_stats import CONTENT_STATS, PipelineStats, stat_deltas_query
 from mediaeye.postgres import DBConn
+from mediaeye.urls import url_dirs
 
 class ArticlePipeline:
-    """Pipeline to scrape and process articles"""
+    """Pipeline to scrape and process articles.
+
+    By default every item is written with its own UPDATE and commit. If the spider sets
+    `batch_size`, items are buffered instead and flushed once `batch_size` items are
+    pending or `flush_interval` seconds have passed since the last flush. A flush COPYs
+    the buffer into a temp staging table and applies it with a single UPDATE ... FROM.
+
+    Raw pages go to the ContentStore, and articles only keep their content_hash.
+    Changes to the article counters are written once per flush, or every `flush_interval`
+    seconds when unbuffered."""
     total_count = 0
+    flush_interval = 30
+    staging_columns = ['id', 'content_hash', 'processed_article', 'time_processed',
+                       'processing_method', 'author', 'title', 'date_written', 'date_scraped']
 
     def __init__(self) -> None:
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
+        self.content_store = ContentStore(self.cur)
+        self.stats = PipelineStats(self.cur)
+        self.dbconn.commit()
+        self.batch_size = None
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.flush_stats = []
+
+    def open_spider(self, spider) -> None:
+        """Check the content store's schema and read the buffering settings off the spider"""
+        content_store_ready = self.content_store.is_available()
+        self.dbconn.commit()
+        if not content_store_ready:
+            raise RuntimeError("articles has no content_hash column or article_contents is missing;" \
+                               " run DBConn().migrate() to add them before scraping articles")
+        batch_size = getattr(spider, 'batch_size', None)
+        self.batch_size = int(batch_size) if batch_size else None
+        self.flush_interval = float(getattr(spider, 'flush_interval', None) or self.flush_interval)
+        if self.batch_size:
+            self.cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS article_staging (
+                    id INTEGER,
+                    content_hash CHAR(64),
+                    processed_article TEXT,
+                    time_processed TIMESTAMP,
+                    processing_method INTEGER,
+                    author TEXT,
+                    title TEXT,
+                    date_written DATE,
+                    date_scraped DATE
+                )
+            """)
+            self.dbconn.commit()
+            self.last_flush = time.monotonic()
 
     def close_spider(self, spider) -> None:
-        """Close DB conn and log number of examples"""
+        """Flush any buffered items, close DB conn and log number of examples"""
+        if self.buffer:
+            self.flush(spider)
+        self.write_stats(spider)
         self.dbconn.close(commit=True)
+        if self.flush_stats:
+            n_rows = sum(rows for rows, _ in self.flush_stats)
+            total_time = sum(elapsed for _, elapsed in self.flush_stats)
+            spider.logger.info(f"{len(self.flush_stats)} flushes wrote {n_rows} articles" \
+                               f" in {total_time:.2f}s")
         spider.logger.info(f"\n\nTotal number of examples: {self.total_count}")
 
     def process_item(self, item: ArticleItem, spider):
         """Process raw fields into DB columns, 
         attempt to get the school from schools DB associated,
         and finally insert the incident into the incidents DB"""
+        if self.batch_size:
+            self.buffer.append(item)
+            if len(self.buffer) >= self.batch_size or \
+                    time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush(spider)
+            self.total_count += 1
+            return
+
+        self.write_item(item, spider)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.write_stats(spider)
+            self.last_flush = time.monotonic()
+        self.total_count += 1
+
+    def write_item(self, item: ArticleItem, spider):
+        """Write a single article with its own UPDATE and commit"""
         now = datetime.now()
         today = date.today()
         try:
-            self.cur.execute("""
+            content_hash = self.content_store.put(item['content'])
+            self.cur.execute(stat_deltas_query('articles', CONTENT_STATS, "id = %s", """
                 UPDATE articles
-                SET content = %s, processed_article = %s, time_processed = %s, 
+                SET content_hash = %s, processed_article = %s, time_processed = %s, 
                              processing_method = %s, author = %s, title = %s, 
                              date_written = %s, date_scraped = %s
                 WHERE id = %s
-                RETURNING id;
-            """, (item['content'],item['processed_article'],now,
+                RETURNING *
+            """), (item['id'], content_hash,item['processed_article'],now,
                   item['processing_method'], item['author'], item['title'], 
                   item['date_written'], today,
                   item['id']))
-            
+            _, *deltas = self.cur.fetchone()
             self.dbconn.commit()
+            self.stats.add(dict(zip(CONTENT_STATS, deltas)))
 
             spider.logger.info(f"Article {item['link']} inserted.")
         except Exception as e:
             print(f"An error occurred: {e}")
             self.dbconn.rollback()
 
-        self.total_count += 1
+    @staticmethod
+    def _copy_value(value):
+        """Format a value for COPY's text format, escaping as postgres expects"""
+        if value is None:
+            return '\\N'
+        return str(value).replace('\x00', '') \
+            .replace('\\', '\\\\') \
+            .replace('\t', '\\t') \
+            .replace('\n', '\\n') \
+            .replace('\r', '\\r')
+
+    def flush(self, spider):
+        """COPY buffered items into the staging table and apply them in one UPDATE.
+        If the batch fails, items are retried one by one so only failing rows are lost."""
+        start_time = time.monotonic()
+        now = datetime.now()
+        today = date.today()
+        try:
+            content_hashes = self.content_store.put_many([item['content'] for item in self.buffer])
+            rows = [(item['id'], content_hash, item['processed_article'], now,
+                     item['processing_method'], item['author'], item['title'],
+                     item['date_written'], today)
+                    for item, content_hash in zip(self.buffer, content_hashes)]
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write('\t'.join(self._copy_value(value) for value in row) + '\n')
+            buffer.seek(0)
+            self.cur.execute("TRUNCATE article_staging")
+            self.cur.copy_expert(f"""
+                COPY article_staging ({', '.join(self.staging_columns)}) FROM STDIN
+            """, buffer)
+            in_staging = "id IN (SELECT id FROM article_staging)"
+            self.cur.execute(stat_deltas_query('articles', CONTENT_STATS, in_staging, """
+                UPDATE articles AS a
+                SET content_hash = s.content_hash, processed_article = s.processed_article,
+                    time_processed = s.time_processed, processing_method = s.processing_method,
+                    author = s.author, title = s.title,
+                    date_written = s.date_written, date_scraped = s.date_scraped
+                FROM article_staging AS s
+                WHERE a.id = s.id
+                RETURNING a.*
+            """), ())
+            n_updated, *deltas = self.cur.fetchone()
+            self.dbconn.commit()
+            self.stats.add(dict(zip(CONTENT_STATS, deltas)))
+            elapsed = time.monotonic() - start_time
+            self.flush_stats.append((n_updated, elapsed))
+            spider.logger.info(f"Flushed {n_updated}/{len(rows)} articles in {elapsed:.3f}s")
+        except Exception as e:
+            self.dbconn.rollback()
+            spider.logger.error(f"Batch of {len(self.buffer)} articles failed, writing one by one: {e}")
+            for item in self.buffer:
+                self.write_item(item, spider)
+        self.buffer = []
+        self.write_stats(spider)
+        self.last_flush = time.monotonic()
+
+    def write_stats(self, spider):
+        """Write the accumulated article counter deltas in their own short transaction"""
+        try:
+            self.stats.write()
+            self.dbconn.commit()
+        except Exception as e:
+            self.dbconn.rollback()
+            spider.logger.error(f"An error occurred writing pipeline stats: {e}")
 
 class ArticleInsertPipeline:
-    """Pipeline to scrape and insert articles"""
+    """Pipeline to scrape and insert articles.
+    Links already in articles, from any newspaper, are screened out with a Bloom filter before
+    reaching the DB. The filter is keyed on link alone, like the table's UNIQUE (link)."""
 
     def __init__(self) -> None:
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
+        self.known_links = None
+        self.bloom_path = DEFAULT_BLOOM_PATH
+        self.stats = PipelineStats(self.cur)
+        self.dbconn.commit()
+
+    def open_spider(self, spider) -> None:
+        """Load the filter of known links, building it from the DB on first use"""
+        self.bloom_path = getattr(spider, 'bloom_path', None) or self.bloom_path
+        self.known_links = load_known_links(self.dbconn, self.bloom_path)
+        spider.logger.info(f"Loaded {len(self.known_links)} known links, " +
+                           f"false positive rate {self.known_links.false_positive_rate():.2e}")
 
     def close_spider(self, spider) -> None:
-        """Close DB conn and log number of examples"""
+        """Persist the filter of known links, write the links counter and close DB conn"""
+        try:
+            self.stats.write()
+            self.dbconn.commit()
+        except Exception as e:
+            self.dbconn.rollback()
+            spider.logger.error(f"An error occurred writing pipeline stats: {e}")
+        if self.known_links is not None:
+            self.known_links.save(self.bloom_path)
+            spider.crawler.stats.set_value('bloom/false_positive_rate',
+                                           self.known_links.false_positive_rate())
+            spider.logger.info(f"Saved {len(self.known_links)} known links to {self.bloom_path}, " +
+                               f"false positive rate {self.known_links.false_positive_rate():.2e}")
         self.dbconn.close(commit=True)
 
     def process_item(self, item: ArticleInsertItem, spider):
@@ -64,32 +230,43 @@ class ArticleInsertPipeline:
         now = datetime.now()
         sitemap_df = item['df']
         if (sitemap_df is not None) and ('loc' in sitemap_df.columns):
-            sitemap_df = sitemap_df.dropna(subset=['loc'])
-            url_df = url_to_df(sitemap_df['loc'])
-            if (url_df is not None) and ('dir_1' in url_df.columns):
-                article_df = pd.merge(sitemap_df, url_df, left_on='loc', right_on='url', how='inner')
+            sitemap_df = sitemap_df.dropna(subset=['loc']).reset_index(drop=True)
+            if not sitemap_df.empty:
+                article_df = pd.concat([sitemap_df, url_dirs(sitemap_df['loc'])], axis=1)
                 try:
-                    for col in ['lastmod','dir_2','dir_3','dir_4','dir_5']:
-                        if col not in article_df.columns:
-                            article_df[col] = None
+                    if 'lastmod' not in article_df.columns:
+                        article_df['lastmod'] = None
                     article_df['lastmod'] = article_df['lastmod'].replace({pd.NaT: None})
-                    article_df = article_df.drop_duplicates(subset='url', keep='first')
-                    subset_article_df = article_df[['url','lastmod','sitemap','dir_1','dir_2','dir_3','dir_4','dir_5','last_dir']]
+                    article_df = article_df.drop_duplicates(subset='loc', keep='first')
+                    is_new = [loc not in self.known_links for loc in article_df['loc']]
+                    n_screened = len(is_new) - sum(is_new)
+                    spider.crawler.stats.inc_value('bloom/screened', n_screened)
+                    article_df = article_df[is_new]
+                    subset_article_df = article_df[['loc','lastmod','sitemap','dir_1','dir_2','dir_3','dir_4','dir_5','last_dir']]
                     article_tuples = list(subset_article_df.itertuples(index=False))
                     enriched_article_tuples = [(item['school_id'], item['newspaper_id'], *t) for t in article_tuples]
-                    execute_values(self.cur, """
-                        INSERT INTO articles
-                        (school_id, newspaper_id, link, lastmod, origin_link, dir_1, dir_2, dir_3, dir_4, dir_5, last_dir)
-                        VALUES %s
-                        ON CONFLICT (link) DO NOTHING                        
-                    """, enriched_article_tuples)
+                    inserted = []
+                    if enriched_article_tuples:
+                        inserted = execute_values(self.cur, """
+                            INSERT INTO articles
+                            (school_id, newspaper_id, link, lastmod, origin_link, dir_1, dir_2, dir_3, dir_4, dir_5, last_dir)
+                            VALUES %s
+                            ON CONFLICT (link) DO NOTHING
+                            RETURNING id
+                        """, enriched_article_tuples, fetch=True)
                     self.cur.execute("""
                         UPDATE newspapers
                         SET time_last_scraped = %s
                         WHERE id = %s
                     """, (now, item['newspaper_id']))
                     self.dbconn.commit()
-                    spider.logger.info(f"{len(enriched_article_tuples)} links updated/added for newspaper id {item['newspaper_id']}")
+                    self.stats.add({'links': len(inserted)})
+                    self.known_links.update(article_df['loc'])
+                    spider.logger.info(f"{len(enriched_article_tuples)} links updated/added for newspaper id {item['newspaper_id']}, " +
+                                       f"{n_screened} known links skipped")
                 except Exception as e:
                     self.dbconn.rollback()
+                    if hasattr(spider, 'fetch_cache'):
+                        # Fetch these sitemaps again next run rather than skipping them
+                        spider.fetch_cache.discard(item['newspaper_id'])
                     spider.logger.info(f"An error occurred in ArticleInsertPipeline: {e}")
\ No newline at end of file
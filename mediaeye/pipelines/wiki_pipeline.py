@@ -1,6 +1,7 @@
 from datetime import date
 from psycopg2 import errors
 from psycopg2.errorcodes import UNIQUE_VIOLATION
+from psycopg2.extras import execute_values
 from mediaeye.postgres import DBConn
 from mediaeye.items import WikiItem
 
@@ -8,17 +9,76 @@ class WikiPipeline:
     """
     Pipeline processing entries from the wikipedia page for college student newspapers.
     Takes in the newspaper entries from the spider as WikiItems and adds them to the DB.
+
+    Entries are buffered and written `batch_size` at a time, and at spider close, by a
+    single statement upserting their schools and inserting their newspapers.
     """
+    batch_size = 500
+
     def __init__(self):
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.cur = self.dbconn.cur
+        self.buffer = []
+
+    def open_spider(self, spider):
+        """Read the batch size off the spider"""
+        self.batch_size = int(getattr(spider, 'batch_size', None) or self.batch_size)
 
     def close_spider(self, spider):
         """Called on spider closing"""
+        if self.buffer:
+            self.flush(spider)
         self.dbconn.close(commit=True)
 
     def process_item(self, item: WikiItem, spider):
-        """Insert WikiItems into schools DB"""
+        """Buffer WikiItems for insertion into the schools and newspapers DBs"""
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size:
+            self.flush(spider)
+        return item
+
+    def flush(self, spider):
+        """
+        Write buffered entries in one round trip. A new school takes the link of its first
+        entry and existing schools are left as they are, as when entries were written one by
+        one. If the batch fails, entries are retried one by one.
+        """
+        today = date.today()
+        rows = [(i, item['school_name'], item['newspaper_name'], item['link'], today)
+                for i, item in enumerate(self.buffer)]
+        try:
+            inserted = execute_values(self.cur, """
+                WITH entries (ord, school_name, newspaper_name, link, date_scraped) AS (
+                    VALUES %s
+                ),
+                upserted_schools AS (
+                    INSERT INTO schools (name, origin_link, date_scraped)
+                    SELECT DISTINCT ON (school_name) school_name, link, date_scraped
+                    FROM entries
+                    ORDER BY school_name, ord
+                    ON CONFLICT (name) DO UPDATE
+                    SET name = EXCLUDED.name
+                    RETURNING id, name
+                )
+                INSERT INTO newspapers (school_id, name, origin_link, date_scraped)
+                SELECT s.id, e.newspaper_name, e.link, e.date_scraped
+                FROM entries e
+                JOIN upserted_schools s ON s.name = e.school_name
+                ORDER BY e.ord
+                ON CONFLICT (school_id, name) DO NOTHING
+                RETURNING id
+            """, rows, page_size=len(rows), fetch=True)
+            self.dbconn.commit()
+            spider.logger.info(f"{len(inserted)}/{len(rows)} newspapers inserted.")
+        except Exception as e:
+            self.dbconn.rollback()
+            spider.logger.error(f"Batch of {len(rows)} entries failed, writing one by one: {e}")
+            for item in self.buffer:
+                self.write_item(item, spider)
+        self.buffer = []
+
+    def write_item(self, item: WikiItem, spider):
+        """Insert a single WikiItem into schools DB"""
         today = date.today()
         try:
             # Insert into schools table
@@ -47,5 +107,3 @@ class WikiPipeline:
             # Rollback the transaction for any other exception
             self.dbconn.rollback()
             spider.logger.error(f"An error occurred: {e}")
-
-        return item
\ No newline at end of file
@@ -1,10 +1,131 @@
 """Module providing an interface to the postgres database."""
 
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import os
+import threading
+import time
 import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from .frontier import PENDING_ARTICLES_CONDITION
 from .py_config import POSTGRES_DATA
 
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 16
+POOL_TIMEOUT = 30 # Seconds to wait for a free pooled connection
+ARTICLE_PARTITIONS = 16 # Hash partitions of a partitioned articles table
+PARTITION_BATCH_SIZE = 50_000 # Article ids copied per transaction by partition_articles
+# Weighted full-text document of an article, kept in articles.search_vector
+SEARCH_CONFIG = 'english'
+SEARCH_VECTOR = f"""setweight(to_tsvector('{SEARCH_CONFIG}', COALESCE(title, '')), 'A')
+                || setweight(to_tsvector('{SEARCH_CONFIG}', COALESCE(processed_article, '')), 'B')"""
+# Slack on the copy start time when catching up, as pipelines stamp rows with their own clock
+CATCH_UP_MARGIN = timedelta(minutes=10)
+
+class ConnectionPool:
+    """
+    Thread-safe pool of postgres connections shared by everything in a process.
+
+    Unlike psycopg2's pools, getconn waits up to `timeout` seconds for a connection instead of
+    failing immediately when all are in use. Utilisation and wait times are tracked in `metrics`.
+    """
+    def __init__(self, minconn=POOL_MIN_CONN, maxconn=POOL_MAX_CONN, **conn_kwargs) -> None:
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        self.maxconn = maxconn
+        self.pid = os.getpid()
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def getconn(self, timeout=POOL_TIMEOUT):
+        """Take a connection from the pool, waiting up to timeout seconds for one"""
+        start_time = time.monotonic()
+        if not self.slots.acquire(timeout=timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise PoolError(f"No pooled connection free after {timeout}s")
+        try:
+            connection = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+        wait = time.monotonic() - start_time
+        with self.lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.acquisitions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return connection
+
+    def putconn(self, connection, close=False):
+        """Return a connection to the pool. Uncommitted work on it is rolled back."""
+        self.pool.putconn(connection, close=close)
+        with self.lock:
+            self.in_use -= 1
+        self.slots.release()
+
+    @contextmanager
+    def session(self, timeout=POOL_TIMEOUT):
+        """Yield a cursor on a pooled connection, committing on success and rolling back on error"""
+        connection = self.getconn(timeout)
+        try:
+            with connection.cursor() as cur:
+                yield cur
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.putconn(connection)
+
+    def metrics(self) -> dict:
+        """Pool utilisation and connection wait statistics"""
+        with self.lock:
+            return {
+                'in_use': self.in_use,
+                'max_connections': self.maxconn,
+                'utilisation': self.in_use / self.maxconn,
+                'peak_in_use': self.peak_in_use,
+                'acquisitions': self.acquisitions,
+                'timeouts': self.timeouts,
+                'total_wait': self.total_wait,
+                'mean_wait': self.total_wait / self.acquisitions if self.acquisitions else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+    def closeall(self):
+        """Close every pooled connection"""
+        self.pool.closeall()
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """The process-wide pool, created on first use (and again in forked children)"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL.pid != os.getpid():
+            _POOL = ConnectionPool(**POSTGRES_DATA)
+        return _POOL
+
+def session(timeout=POOL_TIMEOUT):
+    """Transactional cursor on a connection from the process-wide pool"""
+    return get_pool().session(timeout)
+
+def pool_metrics() -> dict:
+    """Metrics of the process-wide pool"""
+    return get_pool().metrics()
+
 class DBConn:
-    """Class for connection to the postgres database"""
+    """Class for connection to the postgres database.
+    With pooled=True the connection is borrowed from the process-wide pool and
+    handed back on close instead of being closed."""
     table_fields = {
         'schools':"""
             id SERIAL PRIMARY KEY,
@@ -31,9 +152,16 @@ class DBConn:
             time_last_scraped TIMESTAMP,
             date_link_scraped DATE,
             link_is_accurate BOOLEAN,
+            is_wordpress BOOLEAN,
             UNIQUE (school_id, name)
         """,
-        'articles':"""
+        'article_contents':"""
+            hash CHAR(64) PRIMARY KEY,
+            body BYTEA,
+            size INTEGER,
+            time_stored TIMESTAMP DEFAULT NOW()
+        """,
+        'articles':f"""
             id SERIAL PRIMARY KEY,
             school_id INTEGER REFERENCES schools(id) ON DELETE RESTRICT,
             newspaper_id INTEGER REFERENCES newspapers(id) ON DELETE RESTRICT,
@@ -41,6 +169,7 @@ class DBConn:
             date_scraped DATE,
             link VARCHAR(255),
             content TEXT,
+            content_hash CHAR(64) REFERENCES article_contents(hash) ON DELETE RESTRICT,
             processed_article TEXT,
             time_processed TIMESTAMP,
             processing_method INTEGER,
@@ -57,6 +186,10 @@ class DBConn:
             is_filtered BOOLEAN,
             time_filtered TIMESTAMP,
             filter_status VARCHAR(255),
+            filter_rules_version VARCHAR(64),
+            lease_owner VARCHAR(127),
+            lease_expires TIMESTAMP,
+            search_vector TSVECTOR GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED,
             UNIQUE (link)
         """,
         'incidents':"""
@@ -69,32 +202,83 @@ class DBConn:
             amcha_web_id VARCHAR(127),
             category_raw VARCHAR(127),
             classification_raw VARCHAR(255),
-            school_web_id VARCHAR(127)
-            school_name VARCHAR(255)
-            photos_link VARCHAR(255)
-            bds_vote_passed BOOLEAN
-            school_response TEXT
-            targeting_jewish_students_and_staff BOOLEAN
-            antisemitic_expression BOOLEAN
-            physical_assault BOOLEAN
-            discrimination BOOLEAN
-            destruction_of_jewish_property BOOLEAN
-            genocidal_expression BOOLEAN
-            suppression_of_speech_movement_assembly BOOLEAN
-            bullying BOOLEAN
-            denigration BOOLEAN
-            historical BOOLEAN
-            condoning_terrorism BOOLEAN
-            denying_jews_self_determination BOOLEAN
-            demonization BOOLEAN
-            bds_activity BOOLEAN
+            school_web_id VARCHAR(127),
+            school_name VARCHAR(255),
+            photos_link VARCHAR(255),
+            bds_vote_passed BOOLEAN,
+            school_response TEXT,
+            targeting_jewish_students_and_staff BOOLEAN,
+            antisemitic_expression BOOLEAN,
+            physical_assault BOOLEAN,
+            discrimination BOOLEAN,
+            destruction_of_jewish_property BOOLEAN,
+            genocidal_expression BOOLEAN,
+            suppression_of_speech_movement_assembly BOOLEAN,
+            bullying BOOLEAN,
+            denigration BOOLEAN,
+            historical BOOLEAN,
+            condoning_terrorism BOOLEAN,
+            denying_jews_self_determination BOOLEAN,
+            demonization BOOLEAN,
+            bds_activity BOOLEAN,
             UNIQUE (amcha_web_id)
+        """,
+        'dir_filters':"""
+            dir VARCHAR(255) PRIMARY KEY,
+            filter_status VARCHAR(255),
+            is_filtered BOOLEAN,
+            rules_version VARCHAR(64)
+        """,
+        'fetch_cache':"""
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            body_hash CHAR(64),
+            sitemaps TEXT[],
+            time_fetched TIMESTAMP
+        """,
+        'pipeline_stats':"""
+            name VARCHAR(63) PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0,
+            time_updated TIMESTAMP
+        """,
+        'schema_migrations':"""
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            time_applied TIMESTAMP DEFAULT NOW()
         """
     }
-    def __init__(self) -> None:
-        self.connection = psycopg2.connect(**POSTGRES_DATA)
+    def __init__(self, pooled=False) -> None:
+        self.pool = get_pool() if pooled else None
+        if self.pool:
+            self.connection = self.pool.getconn()
+        else:
+            self.connection = psycopg2.connect(**POSTGRES_DATA)
         self.cur = self.connection.cursor()
 
+    def __del__(self):
+        # Hand a forgotten pooled connection back rather than leaking a pool slot
+        if getattr(self, 'pool', None) and getattr(self, 'connection', None):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.rollback()
+        self.close(commit=exc_type is None)
+
+    @contextmanager
+    def session(self):
+        """Yield the cursor inside a transaction, committing on success and rolling back on error"""
+        try:
+            yield self.cur
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+
     def print_all_table_names(self):
         """Print the name of all tables"""
         self.cur.execute("""
@@ -114,12 +298,204 @@ class DBConn:
         )
         """)
 
-    def create_all_tables(self):
-        """Create all tables in a proper order"""
+    def create_partitioned_articles(self, name='articles', n_partitions=ARTICLE_PARTITIONS):
+        """
+        Create an articles table hash partitioned by link, if it does not exist.
+
+        Unique constraints on a partitioned table must include the partition key, so
+        partitioning by link keeps UNIQUE (link) global and the pipelines' ON CONFLICT (link)
+        unchanged, and lookups by link touch one partition. The primary key on id cannot
+        be kept; a plain index on id serves lookups by id, probing each partition.
+        """
+        fields = DBConn.table_fields['articles'].replace("id SERIAL PRIMARY KEY,", "id SERIAL,")
+        self.cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            {fields}
+        ) PARTITION BY HASH (link)
+        """)
+        for remainder in range(n_partitions):
+            self.cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name}_p{remainder} PARTITION OF {name}
+            FOR VALUES WITH (MODULUS {n_partitions}, REMAINDER {remainder})
+            """)
+        self.cur.execute(f"CREATE INDEX IF NOT EXISTS {name}_id_idx ON {name} (id)")
+
+    def create_all_tables(self, partition_articles=False, n_partitions=ARTICLE_PARTITIONS):
+        """
+        Create all tables in a proper order, then apply migrations for their indexes.
+        With partition_articles, articles is created hash partitioned by link.
+        """
         self.create_table('schools')
         self.create_table('newspapers')
-        self.create_table('articles')
+        self.create_table('article_contents')
+        if partition_articles:
+            self.create_partitioned_articles(n_partitions=n_partitions)
+        else:
+            self.create_table('articles')
         self.create_table('incidents')
+        self.create_table('fetch_cache')
+        self.create_table('dir_filters')
+        self.migrate()
+
+    def applied_migrations(self):
+        """Versions of the migrations applied to this database"""
+        self.create_table('schema_migrations')
+        self.cur.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in self.cur.fetchall()}
+
+    def migrate(self, target=None):
+        """
+        Apply pending MIGRATIONS up to version target, in order, committing after each.
+        Migrations are idempotent so databases created from the current table_fields
+        can be brought under version control too.
+
+        Returns:
+            list: Versions applied.
+        """
+        applied = self.applied_migrations()
+        self.commit()
+        newly_applied = []
+        for version, description, statements in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            try:
+                for statement in statements:
+                    self.cur.execute(statement)
+                self.cur.execute("""
+                    INSERT INTO schema_migrations (version, description)
+                    VALUES (%s, %s)
+                """, (version, description))
+                self.commit()
+            except Exception:
+                self.rollback()
+                raise
+            newly_applied.append(version)
+            print(f"Applied migration {version}: {description}")
+        return newly_applied
+
+    def _article_copy_columns(self, table):
+        """Columns of a table that can be written, i.e. not generated"""
+        self.cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+            ORDER BY ordinal_position
+        """, (table,))
+        return [row[0] for row in self.cur.fetchall()]
+
+    def partition_articles(self, n_partitions=ARTICLE_PARTITIONS, batch_size=PARTITION_BATCH_SIZE):
+        """
+        Move an unpartitioned articles table into a hash partitioned one while pipelines
+        keep running.
+
+        Rows are copied into articles_new in id batches, one transaction each. A catch-up
+        pass then upserts rows added since, or processed or filtered since the copy began
+        (by time_processed and time_filtered). Finally, under an exclusive lock, a last
+        catch-up runs, the tables swap names and the id sequence continues from the old one.
+        The old table is kept as articles_unpartitioned.
+
+        Changes that set neither timestamp, and rows whose inserting transaction was still
+        open when the copy began, are not caught up.
+        """
+        self.cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('articles')")
+        row = self.cur.fetchone()
+        if row is None or row[0] == 'p':
+            raise ValueError("articles is missing or already partitioned")
+        # Catch-up matches rows by link, which a NULL never conflicts on
+        self.cur.execute("SELECT COUNT(*) FROM articles WHERE link IS NULL")
+        n_orphans = self.cur.fetchone()[0]
+        if n_orphans:
+            raise ValueError(f"{n_orphans} articles have no link to partition by")
+        self.cur.execute("SELECT NOW(), COALESCE(MAX(id), 0) FROM articles")
+        copy_started, max_id = self.cur.fetchone()
+        self.create_partitioned_articles('articles_new', n_partitions)
+        # A resumed move catches up from when the first attempt began, kept on the table
+        self.cur.execute("SELECT obj_description('articles_new'::regclass, 'pg_class')")
+        started_comment = self.cur.fetchone()[0]
+        if started_comment:
+            copy_started = datetime.fromisoformat(started_comment)
+        else:
+            self.cur.execute(f"COMMENT ON TABLE articles_new IS '{copy_started.isoformat()}'")
+        self.commit()
+        catch_up_since = copy_started - CATCH_UP_MARGIN
+
+        columns = ', '.join(self._article_copy_columns('articles_new'))
+        updates = ', '.join(f"{column} = EXCLUDED.{column}"
+                            for column in self._article_copy_columns('articles_new'))
+        self.cur.execute("SELECT COALESCE(MAX(id), 0) FROM articles_new")
+        copied_id = self.cur.fetchone()[0]
+        while copied_id < max_id:
+            self.cur.execute(f"""
+                INSERT INTO articles_new ({columns})
+                SELECT {columns} FROM articles
+                WHERE id > %s AND id <= %s
+                ON CONFLICT DO NOTHING
+            """, (copied_id, copied_id + batch_size))
+            self.commit()
+            copied_id += batch_size
+            print(f"Copied articles up to id {min(copied_id, max_id)} of {max_id}")
+
+        for statement in _article_indexes(ARTICLE_INDEXES, 'articles_new', '_new'):
+            self.cur.execute(statement)
+        self.commit()
+
+        query_catch_up = f"""
+            INSERT INTO articles_new ({columns})
+            SELECT {columns} FROM articles
+            WHERE id > %s OR time_processed >= %s OR time_filtered >= %s
+            ON CONFLICT (link) DO UPDATE SET {updates}
+        """
+        self.cur.execute(query_catch_up, (max_id, catch_up_since, catch_up_since))
+        print(f"Caught up {self.cur.rowcount} articles changed during the copy")
+        self.commit()
+
+        try:
+            self.cur.execute("LOCK TABLE articles IN ACCESS EXCLUSIVE MODE")
+            self.cur.execute(query_catch_up, (max_id, catch_up_since, catch_up_since))
+            self.cur.execute("ALTER TABLE articles RENAME TO articles_unpartitioned")
+            self.cur.execute("ALTER TABLE articles_new RENAME TO articles")
+            self.cur.execute("COMMENT ON TABLE articles IS NULL")
+            for name in ARTICLE_INDEXES:
+                self.cur.execute(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_unpartitioned")
+                self.cur.execute(f"ALTER INDEX {name}_new RENAME TO {name}")
+            self.cur.execute("ALTER INDEX articles_new_id_idx RENAME TO articles_id_idx")
+            self.cur.execute("ALTER SEQUENCE articles_id_seq RENAME TO articles_unpartitioned_id_seq")
+            self.cur.execute("ALTER SEQUENCE articles_new_id_seq RENAME TO articles_id_seq")
+            self.cur.execute("""
+                SELECT setval('articles_id_seq', GREATEST(
+                    (SELECT last_value FROM articles_unpartitioned_id_seq),
+                    (SELECT COALESCE(MAX(id), 1) FROM articles)))
+            """)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        print("articles is now partitioned; the old table remains as articles_unpartitioned")
+
+    def check_indexes(self, queries=None):
+        """
+        EXPLAIN each hot query with sequential scans disabled and report whether
+        every table it reads is reached through an index.
+
+        Returns:
+            dict: Query name to (uses_index, indexes used, tables still scanned sequentially).
+        """
+        queries = queries or HOT_QUERIES
+        results = {}
+        try:
+            self.cur.execute("SET LOCAL enable_seqscan = off")
+            for name, (query, params) in queries.items():
+                self.cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+                plan = self.cur.fetchone()[0][0]['Plan']
+                indexes, seq_scans = set(), set()
+                _collect_scans(plan, indexes, seq_scans)
+                results[name] = (not seq_scans, sorted(indexes), sorted(seq_scans))
+        finally:
+            self.rollback()
+        for name, (uses_index, indexes, seq_scans) in results.items():
+            status = "OK  " if uses_index else "SEQ "
+            detail = ', '.join(indexes) if uses_index else f"seq scan on {', '.join(seq_scans)}"
+            print(f"{status}{name}: {detail}")
+        return results
 
     def drop_table(self, key):
         """Drop a given table"""
@@ -129,8 +505,13 @@ class DBConn:
 
     def purge(self):
         """Drop all tables in proper order"""
+        self.drop_table('schema_migrations')
+        self.drop_table('pipeline_stats')
+        self.drop_table('dir_filters')
+        self.drop_table('fetch_cache')
         self.drop_table('incidents')
         self.drop_table('articles')
+        self.drop_table('article_contents')
         self.drop_table('newspapers')
         self.drop_table('schools')
 
@@ -148,6 +529,155 @@ class DBConn:
             self.commit()
         if self.cur:
             self.cur.close()
+            self.cur = None
         if self.connection:
-            self.connection.close()
-            
\ No newline at end of file
+            if self.pool:
+                self.pool.putconn(self.connection)
+            else:
+                self.connection.close()
+            self.connection = None
+            
+
+def _collect_scans(plan, indexes, seq_scans):
+    """Gather index names and sequentially scanned tables from an EXPLAIN JSON plan"""
+    if 'Index Name' in plan:
+        indexes.add(plan['Index Name'])
+    if plan['Node Type'] == 'Seq Scan':
+        seq_scans.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        _collect_scans(child, indexes, seq_scans)
+
+def _add_columns(table, columns):
+    """ALTER TABLE statement adding columns that may already exist"""
+    return f"ALTER TABLE {table} " + ", ".join(f"ADD COLUMN IF NOT EXISTS {column}"
+                                               for column in columns)
+
+# Secondary indexes of articles, as name to column list and predicate, also rebuilt by
+# DBConn.partition_articles
+ARTICLE_INDEXES = {
+    # ArticleSpider's work list and the frontier's claims, kept small by only
+    # holding articles still to be fetched
+    'articles_pending_idx': f"(lease_expires, id) WHERE {PENDING_ARTICLES_CONDITION}",
+    'articles_unfiltered_idx': "(id) WHERE time_filtered IS NULL",
+    'articles_newspaper_id_idx': "(newspaper_id)",
+    'articles_content_hash_idx': "(content_hash)",
+    'articles_search_idx': "USING GIN (search_vector)",
+}
+
+def _article_indexes(names, table='articles', suffix=''):
+    """CREATE INDEX statements for ARTICLE_INDEXES entries"""
+    return [f"CREATE INDEX IF NOT EXISTS {name}{suffix} ON {table} {ARTICLE_INDEXES[name]}"
+            for name in names]
+
+# Versioned schema changes as (version, description, statements), applied in order by
+# DBConn.migrate. Statements must be idempotent; append new migrations, never edit old ones.
+# They are written out in full rather than built from table_fields or ARTICLE_INDEXES, so
+# later edits to those do not change what an applied migration did.
+MIGRATIONS = [
+    (1, "Columns and tables added after the initial schema", [
+        _add_columns('newspapers', ["is_wordpress BOOLEAN"]),
+        """CREATE TABLE IF NOT EXISTS article_contents (
+            hash CHAR(64) PRIMARY KEY,
+            body BYTEA,
+            size INTEGER,
+            time_stored TIMESTAMP DEFAULT NOW()
+        )""",
+        _add_columns('articles', [
+            "content_hash CHAR(64) REFERENCES article_contents(hash) ON DELETE RESTRICT",
+            "filter_rules_version VARCHAR(64)",
+            "lease_owner VARCHAR(127)",
+            "lease_expires TIMESTAMP",
+        ]),
+        """CREATE TABLE IF NOT EXISTS incidents (
+            id SERIAL PRIMARY KEY,
+            school_id INTEGER REFERENCES schools(id) ON DELETE RESTRICT,
+            origin_link VARCHAR(255),
+            date_scraped DATE,
+            date_occurred DATE,
+            description TEXT,
+            amcha_web_id VARCHAR(127),
+            category_raw VARCHAR(127),
+            classification_raw VARCHAR(255),
+            school_web_id VARCHAR(127),
+            school_name VARCHAR(255),
+            photos_link VARCHAR(255),
+            bds_vote_passed BOOLEAN,
+            school_response TEXT,
+            targeting_jewish_students_and_staff BOOLEAN,
+            antisemitic_expression BOOLEAN,
+            physical_assault BOOLEAN,
+            discrimination BOOLEAN,
+            destruction_of_jewish_property BOOLEAN,
+            genocidal_expression BOOLEAN,
+            suppression_of_speech_movement_assembly BOOLEAN,
+            bullying BOOLEAN,
+            denigration BOOLEAN,
+            historical BOOLEAN,
+            condoning_terrorism BOOLEAN,
+            denying_jews_self_determination BOOLEAN,
+            demonization BOOLEAN,
+            bds_activity BOOLEAN,
+            UNIQUE (amcha_web_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS fetch_cache (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            body_hash CHAR(64),
+            sitemaps TEXT[],
+            time_fetched TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS dir_filters (
+            dir VARCHAR(255) PRIMARY KEY,
+            filter_status VARCHAR(255),
+            is_filtered BOOLEAN,
+            rules_version VARCHAR(64)
+        )""",
+    ]),
+    (2, "Partial and composite indexes for the hot pipeline queries", [
+        """CREATE INDEX IF NOT EXISTS articles_pending_idx ON articles (lease_expires, id)
+            WHERE content IS NULL AND content_hash IS NULL
+            AND filter_status = 'article' AND is_filtered IS TRUE""",
+        "CREATE INDEX IF NOT EXISTS articles_unfiltered_idx ON articles (id) WHERE time_filtered IS NULL",
+        "CREATE INDEX IF NOT EXISTS articles_newspaper_id_idx ON articles (newspaper_id)",
+        "CREATE INDEX IF NOT EXISTS articles_content_hash_idx ON articles (content_hash)",
+        """CREATE INDEX IF NOT EXISTS newspapers_accurate_idx ON newspapers (is_wordpress, id)
+            WHERE link_is_accurate IS TRUE""",
+        """CREATE INDEX IF NOT EXISTS newspapers_wordpress_unknown_idx ON newspapers (id)
+            WHERE link IS NOT NULL AND is_wordpress IS NULL""",
+        "CREATE INDEX IF NOT EXISTS schools_amcha_name_idx ON schools (amcha_name)",
+        "CREATE INDEX IF NOT EXISTS schools_amcha_web_id_idx ON schools (amcha_web_id)",
+    ]),
+    # Adding a stored generated column rewrites articles once; afterwards postgres
+    # recomputes search_vector whenever a row's title or processed_article is written
+    (3, "Full-text search vector over article titles and processed text", [
+        _add_columns('articles', [
+            """search_vector TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', COALESCE(title, '')), 'A')
+                || setweight(to_tsvector('english', COALESCE(processed_article, '')), 'B')
+            ) STORED""",
+        ]),
+        "CREATE INDEX IF NOT EXISTS articles_search_idx ON articles USING GIN (search_vector)",
+    ]),
+]
+
+# Pipeline queries DBConn.check_indexes expects to be served by an index, as (query, params)
+HOT_QUERIES = {
+    'pending_articles': (f"SELECT id, link FROM articles WHERE {PENDING_ARTICLES_CONDITION}", ()),
+    'frontier_claim': (f"""SELECT id FROM articles
+        WHERE {PENDING_ARTICLES_CONDITION}
+        AND (lease_expires IS NULL OR lease_expires < NOW())
+        LIMIT 1000""", ()),
+    'unfiltered_articles': ("SELECT id FROM articles WHERE time_filtered IS NULL", ()),
+    'accurate_newspapers': ("""SELECT id, school_id, link, time_last_scraped FROM newspapers
+        WHERE link_is_accurate IS TRUE""", ()),
+    'wordpress_newspapers': ("""SELECT id, school_id, link, time_last_scraped FROM newspapers
+        WHERE link_is_accurate IS TRUE AND is_wordpress IS TRUE""", ()),
+    'wordpress_unknown_newspapers': ("""SELECT id, link FROM newspapers
+        WHERE link IS NOT NULL AND is_wordpress IS NULL""", ()),
+    'amcha_school': ("SELECT id FROM schools WHERE amcha_name = %s", ("",)),
+    # Served by UNIQUE (link), within a single partition when articles is partitioned
+    'article_by_link': ("SELECT id FROM articles WHERE link = %s", ("",)),
+    'article_search': (f"""SELECT id FROM articles
+        WHERE search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', %s)""", ("israel",)),
+}
@@ -0,0 +1,92 @@
+"""Module providing full-text search over processed articles."""
+from mediaeye.postgres import DBConn, SEARCH_CONFIG
+
+HEADLINE_OPTIONS = "MaxFragments=2, MaxWords=30, MinWords=10"
+
+class ArticleSearch:
+    """
+    Ranked keyword search over articles.search_vector, served by its GIN index.
+
+    Queries use web search syntax: quoted phrases, OR, and -excluded words.
+    Only the requested page is fetched and given highlighted snippets.
+    """
+    def __init__(self, dbconn=None) -> None:
+        self.dbconn = dbconn or DBConn(pooled=True)
+        self.cur = self.dbconn.cur
+
+    @staticmethod
+    def _filters(school_id=None, newspaper_id=None, date_from=None, date_to=None):
+        """WHERE clauses and params for the optional filters. Ids can be one id or a list."""
+        clauses, params = [], []
+        for column, value in [('school_id', school_id), ('newspaper_id', newspaper_id)]:
+            if value is not None:
+                clauses.append(f"a.{column} = ANY(%s)")
+                params.append(list(value) if isinstance(value, (list, tuple, set)) else [value])
+        if date_from is not None:
+            clauses.append("a.date_written >= %s")
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append("a.date_written <= %s")
+            params.append(date_to)
+        return ''.join(f"\n            AND {clause}" for clause in clauses), params
+
+    def search(self, query, school_id=None, newspaper_id=None, date_from=None, date_to=None,
+               page=1, per_page=20):
+        """
+        Articles matching query, best first.
+
+        Args:
+            query (str): Keywords, in web search syntax.
+            school_id, newspaper_id: Restrict to one id or a list of ids.
+            date_from, date_to (date): Inclusive bounds on date_written.
+            page (int): 1-based page number.
+
+        Returns:
+            list: A dict per hit with id, link, title, school_id, newspaper_id,
+            date_written, rank and headline.
+        """
+        filters, filter_params = self._filters(school_id, newspaper_id, date_from, date_to)
+        try:
+            self.cur.execute(f"""
+                WITH q AS (SELECT websearch_to_tsquery('{SEARCH_CONFIG}', %s) AS query),
+                hits AS (
+                    SELECT a.id, ts_rank_cd(a.search_vector, q.query) AS rank
+                    FROM articles a, q
+                    WHERE a.search_vector @@ q.query{filters}
+                    ORDER BY rank DESC, a.id
+                    LIMIT %s OFFSET %s
+                )
+                SELECT a.id, a.link, a.title, a.school_id, a.newspaper_id, a.date_written, hits.rank,
+                       ts_headline('{SEARCH_CONFIG}', COALESCE(a.processed_article, ''), q.query,
+                                   '{HEADLINE_OPTIONS}')
+                FROM hits
+                JOIN articles a ON a.id = hits.id
+                CROSS JOIN q
+                ORDER BY hits.rank DESC, a.id
+            """, (query, *filter_params, per_page, (max(page, 1) - 1) * per_page))
+            rows = self.cur.fetchall()
+            self.dbconn.commit()
+        except Exception:
+            self.dbconn.rollback()
+            raise
+        columns = ['id', 'link', 'title', 'school_id', 'newspaper_id', 'date_written', 'rank', 'headline']
+        return [dict(zip(columns, row)) for row in rows]
+
+    def count(self, query, school_id=None, newspaper_id=None, date_from=None, date_to=None):
+        """Number of articles matching query and the filters, e.g. to number pages"""
+        filters, filter_params = self._filters(school_id, newspaper_id, date_from, date_to)
+        try:
+            self.cur.execute(f"""
+                SELECT COUNT(*) FROM articles a
+                WHERE a.search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', %s){filters}
+            """, (query, *filter_params))
+            n_hits = self.cur.fetchone()[0]
+            self.dbconn.commit()
+        except Exception:
+            self.dbconn.rollback()
+            raise
+        return n_hits
+
+    def close(self):
+        """Hand the connection back"""
+        self.dbconn.close()
@@ -1,11 +1,14 @@
 """Advertools page with timeout arg and error catching added. Filtering added"""
 
+import io
 import logging
 from concurrent import futures
 from gzip import GzipFile
+from queue import Full, Queue
+import threading
 from xml.etree import ElementTree
 from urllib.request import Request, urlopen
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
 import pandas as pd
@@ -18,46 +21,152 @@ if not logging.getLogger().hasHandlers():
 
 headers = {"User-Agent": "advertools-" + version}
 MAX_TIME = 60 # Used in timeout param
+CHUNK_SIZE = 10_000 # Max rows per chunk yielded by SitemapStream
+READ_SIZE = 64 * 1024 # Bytes fed to the XML parser at a time
+QUEUED_CHUNKS_PER_WORKER = 2 # Parsed chunks waiting for the caller, per worker
+GZIP_MAGIC = b"\x1f\x8b"
 
-def _sitemaps_from_robotstxt(robots_url, request_headers):
+def _sitemaps_from_robotstxt(robots_url, request_headers, cache=None, cache_owner=None):
     sitemaps = []
-    robots_page = urlopen(Request(robots_url, headers=request_headers), timeout=MAX_TIME)
-    for line in robots_page.readlines():
+    if cache is not None:
+        request_headers = {**request_headers, **cache.request_headers(robots_url)}
+    try:
+        robots_page = urlopen(Request(robots_url, headers=request_headers), timeout=MAX_TIME)
+    except HTTPError as e:
+        if e.code == 304 and cache is not None and cache.sitemaps(robots_url) is not None:
+            return cache.sitemaps(robots_url)
+        raise
+    robots_body = robots_page.read()
+    for line in robots_body.splitlines():
         line_split = [s.strip() for s in line.decode().split(":", maxsplit=1)]
         if line_split[0].lower() == "sitemap":
             sitemaps.append(line_split[1])
+    if cache is not None:
+        cache.record(robots_url,
+                     etag=robots_page.headers.get("ETag"),
+                     last_modified=robots_page.headers.get("Last-Modified"),
+                     body_hash=cache.body_hash(robots_body),
+                     sitemaps=sitemaps, owner=cache_owner)
     return sitemaps
 
 
-def _parse_sitemap(root):
-    d = dict()
-    for node in root:
-        for n in node:
-            if "loc" in n.tag:
-                d[n.text] = {}
-
-    def parse_xml_node(node, node_url, prefix=""):
-        nonlocal d
-        keys = []
-        for element in node:
-            if element.text:
-                tag = element.tag.split("}")[-1]
-                d[node_url][prefix + tag] = element.text
-                keys.append(tag)
-                prefix = prefix if tag in keys else ""
-            if list(element):
-                parse_xml_node(
-                    element, node_url, prefix=element.tag.split("}")[-1] + "_"
-                )
-
-    for node in root:
-        node_urls = [n.text for n in node if "loc" in n.tag]
-        if not node_urls:
-            logging.warning(f"No <loc> tag found in a sitemap node: {node}")
-            continue  # Skip nodes without a <loc> tag
-        node_url = node_urls[0]
-        parse_xml_node(node, node_url=node_url)
-    return pd.DataFrame(d.values())
+def _local_name(tag):
+    return tag.split("}")[-1]
+
+
+def _flatten_node(node, prefix=""):
+    """Flatten a <url> or <sitemap> node into a dict of tag to text, prefixing nested tags
+    with their parent's name (e.g. news_title)"""
+    row = {}
+    for element in node:
+        tag = prefix + _local_name(element.tag)
+        text = element.text.strip() if element.text else ""
+        if text:
+            row.setdefault(tag, text)
+        if len(element):
+            for key, val in _flatten_node(element, prefix=tag + "_").items():
+                row.setdefault(key, val)
+    return row
+
+
+def _utc_timestamp(value):
+    """Convert a datetime-like to a UTC timestamp, treating naive values as UTC"""
+    if value is None or pd.isna(value):
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize("UTC")
+    return timestamp.tz_convert("UTC")
+
+
+def _decompressed(stream):
+    """Wrap a binary stream in a GzipFile if it starts with the gzip magic number"""
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(stream)
+    if stream.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return GzipFile(fileobj=stream)
+    return stream
+
+
+class SitemapStream:
+    """
+    Incrementally parses a sitemap or sitemap index, yielding its entries as DataFrame chunks.
+
+    The source is read and fed to the XML parser in blocks, gzipped sources are decompressed
+    on the fly, and each top level <url> or <sitemap> node is dropped from the tree once
+    flattened, so memory stays bounded by chunk_size regardless of the sitemap's size.
+    Each chunk has a `loc` column, one column per (flattened) child tag and a `sitemap`
+    column. `lastmod` is always present and parsed, NaT where missing, and for urlsets rows
+    older than last_scraped are dropped per chunk. Rows without a lastmod are kept.
+
+    :param source: A binary file-like object (e.g. an HTTP response) or bytes.
+    :param str sitemap_url: URL of the sitemap, stored in the `sitemap` column.
+    :param last_scraped: Only keep urls modified at or after this time, if given.
+    :param int chunk_size: Maximum number of rows per chunk.
+    """
+    def __init__(self, source, sitemap_url, last_scraped=None, chunk_size=CHUNK_SIZE):
+        self.source = io.BytesIO(source) if isinstance(source, bytes) else source
+        self.sitemap_url = sitemap_url
+        self.last_scraped = _utc_timestamp(last_scraped)
+        self.chunk_size = chunk_size
+        self.kind = None # "urlset" or "sitemapindex" once the root element is read
+        self.size = 0 # Decompressed bytes read so far
+
+    def _to_frame(self, rows):
+        chunk_df = pd.DataFrame(rows)
+        # Every chunk gets a lastmod column, missing and unparsable values being NaT
+        if "lastmod" not in chunk_df:
+            chunk_df["lastmod"] = None
+        chunk_df["lastmod"] = pd.to_datetime(
+            chunk_df["lastmod"], utc=True, format="ISO8601", errors="coerce"
+        )
+        if self.last_scraped is not None and self.kind == "urlset":
+            # Urls without a lastmod cannot be shown to be old, so they are kept
+            is_recent = chunk_df["lastmod"].isna() | (chunk_df["lastmod"] >= self.last_scraped)
+            chunk_df = chunk_df[is_recent]
+        chunk_df["sitemap"] = self.sitemap_url
+        return chunk_df
+
+    def __iter__(self):
+        stream = _decompressed(self.source)
+        parser = ElementTree.XMLPullParser(events=("start", "end"))
+        root = None
+        depth = 0
+        rows = []
+        while True:
+            data = stream.read(READ_SIZE)
+            if data:
+                self.size += len(data)
+                parser.feed(data)
+            else:
+                parser.close()
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = elem
+                        self.kind = _local_name(elem.tag)
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                row = _flatten_node(elem)
+                if "loc" in row:
+                    rows.append(row)
+                else:
+                    logging.warning(f"No <loc> tag found in a sitemap node: {elem}")
+                root.clear()
+                if len(rows) >= self.chunk_size:
+                    chunk_df = self._to_frame(rows)
+                    rows = []
+                    if not chunk_df.empty:
+                        yield chunk_df
+            if not data:
+                break
+        if rows:
+            chunk_df = self._to_frame(rows)
+            if not chunk_df.empty:
+                yield chunk_df
 
 
 def _build_request_headers(user_headers=None):
@@ -84,20 +193,23 @@ def _filter_sitemap(sitemap_url, last_scraped):
 
     return True
 
-def sitemap_to_df(sitemap_url, max_workers=8, recursive=True, request_headers=None, last_scraped=None):
+def sitemap_to_df(sitemap_url, max_workers=8, recursive=True, request_headers=None, last_scraped=None,
+                  cache=None, cache_owner=None):
     """
     Retrieve all URLs and other available tags of a sitemap(s) and put them in
     a DataFrame.
 
     You can also pass the URL of a sitemap index, or a link to a robots.txt
-    file.
+    file. To process large sitemaps in bounded memory, iterate over
+    `iter_sitemap` instead, which takes the same arguments.
 
     :param url sitemap_url: The URL of a sitemap, either a regular sitemap, a
                             sitemap index, or a link to a robots.txt file.
                             In the case of a sitemap index or robots.txt, the
                             function will go through all the sub sitemaps and
                             retrieve all the included URLs in one DataFrame.
-    :param int max_workers: The maximum number of workers to use for threading.
+    :param int max_workers: The maximum number of workers to use for threading,
+                            shared by all nested sitemap indexes.
                             The higher the faster, but with high numbers you
                             risk being blocked and/or missing some data as you
                             might appear like an attacker.
@@ -109,108 +221,251 @@ def sitemap_to_df(sitemap_url, max_workers=8, recursive=True, request_headers=No
                            interested in.
     :param dict request_headers: One or more request headers to use while
                                  fetching the sitemap.
+    :param FetchCache cache: If given, sitemaps are fetched conditionally and
+                             those that come back 304, or with an unchanged
+                             body, are skipped (an empty DataFrame). The
+                             sitemaps of such an index are still fetched,
+                             conditionally, from its cached list. An index
+                             is only cached once all its sitemaps were read.
+    :param cache_owner: Owner under which new cache entries are recorded.
     :return sitemap_df: A pandas DataFrame containing all URLs, as well as
                         other tags if available (``lastmod``, ``changefreq``,
                         ``priority``, or others found in news, video, or image
                         sitemaps).
     """
+    frames = {}
+    for node, chunk_df in _iter_sitemap_chunks(sitemap_url, max_workers, recursive, request_headers,
+                                               last_scraped, cache, cache_owner):
+        frames.setdefault(node, []).append(chunk_df)
+    if not frames:
+        return pd.DataFrame()
+    # Concatenate once, in discovery order
+    return pd.concat([chunk_df for node in sorted(frames) for chunk_df in frames[node]],
+                     ignore_index=True)
+
+def iter_sitemap(sitemap_url, max_workers=8, recursive=True, request_headers=None, last_scraped=None,
+                 cache=None, cache_owner=None):
+    """
+    Like sitemap_to_df, but yield the rows as DataFrame chunks of at most CHUNK_SIZE rows
+    as they are parsed. Chunks of different sitemaps are interleaved. Workers wait while
+    the caller is behind, so memory stays bounded by the chunks in flight however many
+    urls the sitemaps hold.
+    """
+    for _, chunk_df in _iter_sitemap_chunks(sitemap_url, max_workers, recursive, request_headers,
+                                            last_scraped, cache, cache_owner):
+        yield chunk_df
+
+def _iter_sitemap_chunks(sitemap_url, max_workers, recursive, request_headers, last_scraped,
+                         cache, cache_owner):
+    """
+    Drive the sitemaps reached from sitemap_url breadth first over one shared executor,
+    yielding (node, chunk_df) with sitemaps numbered in discovery order.
+    """
     final_headers = _build_request_headers(request_headers)
+    if sitemap_url.endswith("robots.txt"):
+        try:
+            roots = _sitemaps_from_robotstxt(sitemap_url, final_headers, cache, cache_owner)
+        except (HTTPError, URLError) as e:
+            logging.warning(f"Error while accessing {sitemap_url}: {e}")
+            yield 0, pd.DataFrame({"sitemap": [sitemap_url], "errors": [str(e)]})
+            return
+        if not roots:
+            raise ValueError(f"No sitemaps listed in {sitemap_url}")
+    else:
+        roots = [sitemap_url]
+
+    urls = {}
+    # Per sitemap index node: [url, children left, whether any failed, cache entry]
+    indexes = {}
+    parents = {}
+    seen = set()
+    errored = set()
+    next_node = 0
+    n_running = 0
+    results = Queue(maxsize=max_workers * QUEUED_CHUNKS_PER_WORKER)
+    stop = threading.Event()
+
+    def settle(node, had_errors):
+        """Mark a node fully read, then settle the indexes above it that have no children left"""
+        while True:
+            state = indexes.pop(node, None)
+            if state is not None and state[3] is not None and not had_errors:
+                # Only skip this index next time if all of its sitemaps were read
+                cache.record(state[0], **state[3])
+            parent = parents.pop(node, None)
+            if parent is None:
+                return
+            parent_state = indexes[parent]
+            parent_state[1] -= 1
+            parent_state[2] = parent_state[2] or had_errors
+            if parent_state[1] > 0:
+                return
+            node, had_errors = parent, parent_state[2]
 
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(url, parent=None):
+        nonlocal next_node, n_running
+        if url in seen:
+            return False
+        seen.add(url)
+        node = next_node
+        next_node += 1
+        urls[node] = url
+        if parent is not None:
+            parents[node] = parent
+        executor.submit(_fetch_into, results, stop, node, url, recursive, request_headers,
+                        last_scraped, cache, cache_owner)
+        n_running += 1
+        return True
+
+    try:
+        for root in roots:
+            submit(root)
+        while n_running:
+            kind, node, value = results.get()
+            url = urls[node]
+            if kind == "chunk":
+                if "errors" in value:
+                    errored.add(node)
+                yield node, value
+                continue
+            n_running -= 1
+            if kind == "error":
+                logging.warning(msg=str(value) + " " + url)
+                yield node, pd.DataFrame({"sitemap": [url], "errors": [str(value)]})
+                settle(node, True)
+                continue
+            children, cache_entry = value
+            if children is None:
+                settle(node, node in errored)
+                continue
+            # A sitemap index: fan out to its children on the same executor
+            indexes[node] = [url, 0, False, cache_entry]
+            if url in children:
+                yield node, pd.DataFrame({
+                    "sitemap": [url],
+                    "errors": ["WARNING: Sitemap contains a link to itself"],
+                })
+                indexes[node][2] = True
+            for child in children:
+                if child != url and submit(child, node):
+                    indexes[node][1] += 1
+            if indexes[node][1] == 0:
+                settle(node, indexes[node][2])
+    finally:
+        # Let workers blocked on a full queue exit if the caller stopped early
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _fetch_into(results, stop, node, *fetch_args):
+    """
+    Run _fetch_sitemap in a worker, putting ("chunk", node, chunk_df) on results for each
+    chunk, then ("done", node, (children, cache_entry)) or ("error", node, exception).
+    """
+    def put(message):
+        while not stop.is_set():
+            try:
+                results.put(message, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    try:
+        fetch = _fetch_sitemap(*fetch_args)
+        while True:
+            try:
+                chunk_df = next(fetch)
+            except StopIteration as done:
+                put(("done", node, done.value))
+                return
+            if not put(("chunk", node, chunk_df)):
+                return
+    except Exception as e:
+        put(("error", node, e))
+
+def _fetch_sitemap(sitemap_url, recursive, request_headers, last_scraped, cache, cache_owner):
+    """
+    Fetch and parse one sitemap, yielding its rows (or its error) as DataFrame chunks.
+
+    The generator returns (children, cache_entry): for a sitemap index followed recursively,
+    children lists its sitemaps and cache_entry is what to record once they are all read;
+    otherwise both are None. An unchanged index returns its cached children and no cache_entry.
+    """
+    def unchanged(message):
+        """Skip an unchanged sitemap, except for the children of an index"""
+        logging.info(f"{message} {sitemap_url}")
+        cached_children = cache.sitemaps(sitemap_url)
+        if recursive and cached_children:
+            return cached_children, None
+        return None, None
+
+    final_headers = _build_request_headers(request_headers)
     try:
-        if sitemap_url.endswith("robots.txt"):
-            return pd.concat(
-                [
-                    sitemap_to_df(sitemap, recursive=recursive, last_scraped=last_scraped)
-                    for sitemap in _sitemaps_from_robotstxt(sitemap_url, final_headers)
-                ],
-                ignore_index=True,
-            )
-        
         if not _filter_sitemap(sitemap_url, last_scraped):
-            return pd.DataFrame()
+            return None, None
 
         if sitemap_url.endswith("xml.gz"):
             final_headers["accept-encoding"] = "gzip"
-            xml_text = urlopen(Request(sitemap_url, headers=final_headers), timeout=MAX_TIME)
-            try:
-                resp_headers = xml_text.getheaders()
-            except AttributeError:
-                resp_headers = ""
-                pass
-            xml_text = GzipFile(fileobj=xml_text)
-        else:
-            xml_text = urlopen(Request(sitemap_url, headers=final_headers), timeout=MAX_TIME)
-            try:
-                resp_headers = xml_text.getheaders()
-            except AttributeError:
-                resp_headers = ""
-                pass
-        xml_string = xml_text.read()
-        root = ElementTree.fromstring(xml_string)
+        if cache is not None:
+            final_headers.update(cache.request_headers(sitemap_url))
+        response = urlopen(Request(sitemap_url, headers=final_headers), timeout=MAX_TIME)
+        try:
+            resp_headers = response.getheaders()
+        except AttributeError:
+            resp_headers = ""
+        source = response
+        if cache is not None:
+            # The whole body is needed up front to compare its hash
+            source = response.read()
+            body_hash = cache.body_hash(source)
+            if cache.is_unchanged(sitemap_url, body_hash):
+                return unchanged("Skipping unchanged sitemap")
+        stream = SitemapStream(source, sitemap_url, last_scraped=last_scraped)
+        cache_entry = None
+        if cache is not None:
+            cache_entry = dict(etag=response.headers.get("ETag"),
+                               last_modified=response.headers.get("Last-Modified"),
+                               body_hash=body_hash, owner=cache_owner)
+    except HTTPError as e:
+        if e.code == 304 and cache is not None:
+            return unchanged("Skipping not modified sitemap")
+        logging.warning(f"Error while accessing {sitemap_url}: {e}")
+        yield pd.DataFrame({"sitemap": [sitemap_url], "errors": [str(e)]})
+        return None, None
     except URLError as e:
         if hasattr(e, "reason") and isinstance(e.reason, TimeoutError):
             logging.warning(f"Timeout error while accessing {sitemap_url}: {e}")
         else:
             logging.warning(f"Error while accessing {sitemap_url}: {e}")
-        return pd.DataFrame({"sitemap": [sitemap_url], "errors": [str(e)]})
-
-    sitemap_df = pd.DataFrame()
-
-    if (root.tag.split("}")[-1] == "sitemapindex") and recursive:
-        multi_sitemap_df = pd.DataFrame()
-        sitemap_url_list = []
-        for elem in root:
-            for el in elem:
-                if "loc" in el.tag:
-                    if el.text == sitemap_url:
-                        error_df = pd.DataFrame(
-                            {
-                                "sitemap": [sitemap_url],
-                                "errors": [
-                                    "WARNING: Sitemap contains a link to itself"
-                                ],
-                            }
-                        )
-                        multi_sitemap_df = pd.concat(
-                            [multi_sitemap_df, error_df], ignore_index=True
-                        )
-                    else:
-                        sitemap_url_list.append(el.text)
-        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            to_do = []
-            for sitemap in sitemap_url_list:
-                future = executor.submit(sitemap_to_df, sitemap, last_scraped=last_scraped)
-                to_do.append(future)
-            done_iter = futures.as_completed(to_do)
-            for future in done_iter:
-                try:
-                    multi_sitemap_df = pd.concat(
-                        [multi_sitemap_df, future.result()], ignore_index=True
-                    )
-                except Exception as e:
-                    error_df = pd.DataFrame(dict(errors=str(e)), index=range(1))
-                    future_str = hex(id(future))
-                    hexes = [hex(id(f)) for f in to_do]
-                    index = hexes.index(future_str)
-                    error_df["sitemap"] = sitemap_url_list[index]
-                    logging.warning(msg=str(e) + " " + sitemap_url_list[index])
-                    multi_sitemap_df = pd.concat(
-                        [multi_sitemap_df, error_df], ignore_index=True
-                    )
-        return multi_sitemap_df
+        yield pd.DataFrame({"sitemap": [sitemap_url], "errors": [str(e)]})
+        return None, None
 
-    else:
-        logging.info(msg="Getting " + sitemap_url)
-        elem_df = _parse_sitemap(root)
-        sitemap_df = pd.concat([sitemap_df, elem_df], ignore_index=True)
-        sitemap_df["sitemap"] = [sitemap_url] if sitemap_df.empty else sitemap_url
-    if "lastmod" in sitemap_df:
-        try:
-            sitemap_df["lastmod"] = pd.to_datetime(sitemap_df["lastmod"], utc=True)
-            if last_scraped:
-                sitemap_df = sitemap_df[sitemap_df["lastmod"] >= last_scraped]
-        except Exception:
-            pass
+    children = []
+    n_chunks = 0
+    logging.info(msg="Getting " + sitemap_url)
+    for chunk_df in stream:
+        if (stream.kind == "sitemapindex") and recursive:
+            children.extend(chunk_df["loc"])
+            continue
+        n_chunks += 1
+        yield _with_response_columns(chunk_df, resp_headers, stream.size)
+    if (stream.kind == "sitemapindex") and recursive:
+        if cache_entry:
+            cache_entry["sitemaps"] = children
+        return children, cache_entry
+
+    if not n_chunks:
+        yield _with_response_columns(pd.DataFrame({"sitemap": [sitemap_url]}), resp_headers,
+                                     stream.size)
+    if cache_entry:
+        cache.record(sitemap_url, **cache_entry)
+    return None, None
+
+def _with_response_columns(sitemap_df, resp_headers, size):
+    """Add the response's validators, the decompressed MB read so far and the download
+    time to a chunk of a sitemap's rows"""
     if "priority" in sitemap_df:
         try:
             sitemap_df["priority"] = sitemap_df["priority"].astype(float)
@@ -228,6 +483,6 @@ def sitemap_to_df(sitemap_url, max_workers=8, recursive=True, request_headers=No
             sitemap_df["last_modified"]
         )
         del sitemap_df["last_modified"]
-    sitemap_df["sitemap_size_mb"] = len(xml_string) / 1024 / 1024
+    sitemap_df["sitemap_size_mb"] = size / 1024 / 1024
     sitemap_df["download_date"] = pd.Timestamp.now(tz="UTC")
-    return sitemap_df
\ No newline at end of file
+    return sitemap_df
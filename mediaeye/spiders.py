@@ -1,18 +1,27 @@
 """Module containing scrapy spiders"""
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
+import multiprocessing
+import random
 import re
 import json
 from urllib.error import HTTPError, URLError
-from urllib.parse import urlencode, urlparse, parse_qs
+from urllib.parse import urldefrag, urlencode, urlparse, parse_qs
 from xml.etree import ElementTree
 import pandas as pd
 import requests
 import scrapy
+from scrapy.utils.defer import maybe_deferred_to_future
 from scrapy.utils.log import configure_logging
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 from mediaeye.postgres import DBConn
-from mediaeye.sitemaps import sitemap_to_df
+from mediaeye.fetch_cache import FetchCache
+from mediaeye.frontier import ArticleFrontier, PENDING_ARTICLES_CONDITION
+from mediaeye.sitemaps import SitemapStream
 from mediaeye.items import WikiItem, AmchaUniItem, IncidentItem, ArticleItem, ArticleInsertItem
 from mediaeye.article_extractor import ArticleExtractor
 
@@ -44,6 +53,12 @@ class WikiSpider(scrapy.Spider):
             else:
                 self.logger.info(f"Insufficient li entry for parts {li_text}")
 
+def as_bool(value) -> bool:
+    """Interpret a spider argument, which arrives as a string from the command line, as a bool"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
 def response_to_dict(response) -> dict:
     """Convert a jQuery response to a dict"""
     json_data = re.search(r"jQuery\d+_\d+\s\=+\s'function'\s&&\sjQuery\d+_\d+(.*);",
@@ -187,7 +202,7 @@ class AmchaIncidentSpider(scrapy.Spider):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.conn = self.dbconn.connection
         self.cur = self.dbconn.cur
         self.cur.execute("""
@@ -231,9 +246,28 @@ class AmchaIncidentSpider(scrapy.Spider):
                             origin_link=response.meta['origin_link'])
         yield item
 
+def deferred_from_future(future) -> Deferred:
+    """Wrap a concurrent.futures future in a Deferred fired on the reactor thread"""
+    from twisted.internet import reactor
+    deferred = Deferred()
+    def _on_done(done_future):
+        try:
+            result = done_future.result()
+        except Exception:
+            reactor.callFromThread(deferred.errback, Failure())
+        else:
+            reactor.callFromThread(deferred.callback, result)
+    future.add_done_callback(_on_done)
+    return deferred
+
 class ArticleSpider(scrapy.Spider):
-    """Spider that scrapes articles"""
+    """Spider that scrapes articles.
+    Unfetched articles are streamed from a server-side cursor in batches of
+    cursor_batch_size, each shuffled before its requests are yielded.
+    With use_leases, batches are instead claimed from the shared ArticleFrontier,
+    so several spider processes can run against the same database."""
     name = "article_spider"
+    cursor_batch_size = 2000
     custom_settings = {
         "ITEM_PIPELINES": {"mediaeye.pipelines.ArticlePipeline": 100},
         "AUTOTHROTTLE_ENABLED": True,
@@ -250,38 +284,97 @@ class ArticleSpider(scrapy.Spider):
         },
     }
 
-    def __init__(self, *args,  n=None, **kwargs):
+    def __init__(self, *args,  n=None, batch_size=None, flush_interval=None,
+                 extract_workers=None, use_leases=False, lease_minutes=30, **kwargs):
         super().__init__(*args, **kwargs)
         self.n = n
-        self.dbconn = DBConn()
+        # With extract_workers set, pages are parsed in a process pool instead of on the reactor
+        self.extract_workers = int(extract_workers) if extract_workers else None
+        self.extract_pool = None
+        self.extract_slots = None
+        if self.extract_workers:
+            # Spawned, not forked: this process runs Twisted's threads and holds DB connections
+            self.extract_pool = ProcessPoolExecutor(max_workers=self.extract_workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            self.extract_slots = DeferredSemaphore(2 * self.extract_workers)
+        # Read by ArticlePipeline to buffer writes, see ArticlePipeline.open_spider
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dbconn = DBConn(pooled=True)
         self.conn = self.dbconn.connection
         self.cur = self.dbconn.cur
-        query_select = """SELECT id, link FROM articles 
-        WHERE content IS NULL 
-        AND filter_status = 'article'
-        AND is_filtered IS TRUE"""
-        if self.n:
-            query_select += f"\nLIMIT {n}"
-        self.article_df = pd.read_sql(query_select, self.conn)
-        self.article_df = self.article_df.sample(frac=1, random_state=42)
+        self.random = random.Random(42)
+        self.frontier = None
+        self.leased_ids = set()
+        self.lease_renewal = None
+        if as_bool(use_leases):
+            self.frontier = ArticleFrontier(self.dbconn, lease_minutes=float(lease_minutes))
 
         for handler in logging.root.handlers:
             if handler.level == logging.NOTSET:
                 logging.root.removeHandler(handler)
                 print(f"Removed handler: {handler}")
 
+    def iter_article_batches(self):
+        """Lazily yield shuffled batches of (id, link) for articles without content"""
+        if self.frontier:
+            # Keep leases of queued rows alive however long the scheduler takes to fetch them
+            self.lease_renewal = LoopingCall(self.renew_leases)
+            self.lease_renewal.start(self.frontier.renew_interval, now=False)
+            for rows in self.frontier.iter_batches(self.cursor_batch_size,
+                                                   int(self.n) if self.n else None):
+                self.leased_ids.update(article_id for article_id, _ in rows)
+                self.random.shuffle(rows)
+                yield rows
+            return
+        query_select = f"""SELECT id, link FROM articles 
+        WHERE {PENDING_ARTICLES_CONDITION}"""
+        params = ()
+        if self.n:
+            query_select += "\nLIMIT %s"
+            params = (int(self.n),)
+        # A named cursor keeps the result set on the server and fetches it batch by batch.
+        # WITH HOLD lets it outlive the transaction, so the crawl does not hold a snapshot
+        # open for hours and keep vacuum from cleaning up the articles it updates.
+        with self.conn.cursor(name='article_spider_cursor', withhold=True) as cur:
+            cur.itersize = self.cursor_batch_size
+            cur.execute(query_select, params)
+            self.conn.commit()
+            while True:
+                rows = cur.fetchmany(self.cursor_batch_size)
+                if not rows:
+                    break
+                self.random.shuffle(rows)
+                yield rows
+        self.conn.commit()
+
     def start_requests(self):
-        for _, row in self.article_df.iterrows():
-            article_id = row['id']
-            link = row['link']
-            yield scrapy.Request(
-                url=link, 
-                callback=self.parse, 
-                meta={'id': article_id}, 
-                dont_filter=True
-            )
+        for rows in self.iter_article_batches():
+            for article_id, link in rows:
+                yield scrapy.Request(
+                    url=link, 
+                    callback=self.parse_in_pool if self.extract_pool else self.parse, 
+                    errback=self.on_request_error,
+                    meta={'id': article_id}, 
+                    dont_filter=True
+                )
+
+    def renew_leases(self):
+        """Renew the leases of claimed articles not yet fetched"""
+        try:
+            n_renewed = self.frontier.renew(self.leased_ids)
+            self.logger.info(f"Renewed {n_renewed}/{len(self.leased_ids)} article leases")
+        except Exception as e:
+            self.logger.error(f"Failed to renew article leases: {e}")
+
+    def on_request_error(self, failure):
+        """Log failed downloads, leaving their lease to expire rather than retrying right away"""
+        request = failure.request
+        self.leased_ids.discard(request.meta['id'])
+        self.logger.warning(f"Failed to fetch {request.url}: {failure.value}")
 
     def parse(self, response):
+        self.leased_ids.discard(response.meta['id'])
         if response.status == 200:
             article_id = response.meta['id']
             link = response.url
@@ -296,6 +389,42 @@ class ArticleSpider(scrapy.Spider):
         else:
             self.logger.warning(f"Failed to fetch {response.url} with status {response.status}")
 
+    async def parse_in_pool(self, response):
+        """
+        Like parse, but extraction runs in the process pool so the reactor keeps downloading.
+
+        At most 2 * extract_workers pages are submitted at once. Responses waiting for a slot
+        stay in scrapy's scraper slot, and once those exceed SCRAPER_SLOT_MAX_ACTIVE_SIZE
+        the engine stops sending new downloads until the pool catches up.
+        """
+        self.leased_ids.discard(response.meta['id'])
+        if response.status != 200:
+            self.logger.warning(f"Failed to fetch {response.url} with status {response.status}")
+            return []
+        content = response.text
+        await maybe_deferred_to_future(self.extract_slots.acquire())
+        try:
+            future = self.extract_pool.submit(ArticleExtractor.extract_fields, content)
+            fields = await maybe_deferred_to_future(deferred_from_future(future))
+        finally:
+            self.extract_slots.release()
+        item = ArticleItem(
+            id=response.meta['id'],
+            link=response.url,
+            content=content,
+            **fields
+        )
+        return [item]
+
+    def closed(self, reason):
+        """Shut down the extraction pool and release leases on articles never requested"""
+        if self.extract_pool:
+            self.extract_pool.shutdown(wait=False, cancel_futures=True)
+        if self.lease_renewal is not None and self.lease_renewal.running:
+            self.lease_renewal.stop()
+        if self.frontier:
+            self.frontier.release(self.leased_ids)
+
 class ArticleInsertSpider(scrapy.Spider):
     """Spider that scrapes articles from sitemaps and inserts them"""
     name = "article_insert_spider"
@@ -319,7 +448,7 @@ class ArticleInsertSpider(scrapy.Spider):
         super().__init__(*args, **kwargs)
         self.n = n
         self.wordpress_only = wordpress_only
-        self.dbconn = DBConn()
+        self.dbconn = DBConn(pooled=True)
         self.conn = self.dbconn.connection
         self.cur = self.dbconn.cur
         query_select = """SELECT id, school_id, link, time_last_scraped 
@@ -330,6 +459,12 @@ class ArticleInsertSpider(scrapy.Spider):
         if self.n:
             query_select += f"\nLIMIT {self.n}"
         self.newspaper_df = pd.read_sql(query_select, self.conn)
+        self.fetch_cache = FetchCache(self.dbconn)
+        # Sitemap urls already requested this crawl, per newspaper id
+        self.visited_sitemaps = {}
+        # Sitemap indexes with sitemaps still being read, by node id
+        self.sitemap_indexes = {}
+        self.next_sitemap_node = 0
 
         for handler in logging.root.handlers:
             if handler.level == logging.NOTSET:
@@ -341,55 +476,209 @@ class ArticleInsertSpider(scrapy.Spider):
             base_url = self._get_base_url(row['link'])
             robots_url = f"{base_url}robots.txt"
             sitemap_url = f"{base_url}sitemap.xml"
+            meta = {"base_url": base_url, "newspaper_id": row["id"], "school_id": row["school_id"], "last_scraped": row["time_last_scraped"],
+                    "handle_httpstatus_list": [304]}
             yield scrapy.Request(
                 url=robots_url,
                 callback=self.parse_robots,
-                meta={"base_url": base_url, "newspaper_id": row["id"], "school_id": row["school_id"], "last_scraped": row["time_last_scraped"]},
-                dont_filter=True
-            )
-            yield scrapy.Request(
-                url=sitemap_url,
-                callback=self.parse_sitemap,
-                meta={"base_url": base_url, "newspaper_id": row["id"], "school_id": row["school_id"], "last_scraped": row["time_last_scraped"]},
+                headers=self.fetch_cache.request_headers(robots_url),
+                meta=dict(meta),
                 dont_filter=True
             )
+            # Probed whether or not robots.txt lists it, so a missing one is not a failure
+            request = self._sitemap_request(sitemap_url, meta, root_probe=True)
+            if request is not None:
+                yield request
 
     def parse_robots(self, response):
         """Parse robots.txt to find sitemaps."""
         try:
-            sitemaps = self.extract_sitemaps_from_robots(response.text)
+            if response.status == 304:
+                self.crawler.stats.inc_value("fetch_cache/not_modified")
+                sitemaps = self.fetch_cache.sitemaps(response.url) or []
+            else:
+                sitemaps = self.extract_sitemaps_from_robots(response.text)
+                self.fetch_cache.record(response.url,
+                                        etag=self._header(response, "ETag"),
+                                        last_modified=self._header(response, "Last-Modified"),
+                                        body_hash=self.fetch_cache.body_hash(response.body),
+                                        sitemaps=sitemaps, owner=response.meta["newspaper_id"])
             for sitemap in sitemaps:
                 if self._filter_sitemap(sitemap, response.meta["last_scraped"]):
-                    yield scrapy.Request(
-                        url=sitemap,
-                        callback=self.parse_sitemap,
-                        meta=response.meta
-                )
+                    request = self._sitemap_request(sitemap, response.meta)
+                    if request is not None:
+                        yield request
         except (ValueError, HTTPError, URLError) as e:
             self.logger.warning(f"Error parsing robots.txt at {response.url}: {e}")
 
     def parse_sitemap(self, response):
-        """Parse sitemap to extract URLs."""
+        """Parse sitemap to extract URLs, streaming them to the pipeline in chunks.
+        Sitemaps that are not modified, or unchanged since they were last read, are skipped,
+        though the sitemaps listed by such an index are still requested conditionally."""
+        meta = response.meta
+        parent = meta.get("parent_sitemap")
+        if response.status == 304:
+            self.crawler.stats.inc_value("fetch_cache/not_modified")
+            yield from self._cached_sitemap_requests(response.url, meta, parent)
+            return
+        if meta.get("redirect_urls") and \
+                not self._visit_sitemap(response.url, meta["newspaper_id"]):
+            # Redirected onto a sitemap this newspaper already requested
+            self._sitemap_read(parent)
+            return
+        body_hash = self.fetch_cache.body_hash(response.body)
+        if self.fetch_cache.is_unchanged(response.url, body_hash):
+            self.crawler.stats.inc_value("fetch_cache/unchanged")
+            yield from self._cached_sitemap_requests(response.url, meta, parent)
+            return
+        stream = SitemapStream(response.body, response.url, meta["last_scraped"])
+        node = None
+        children = []
+        failed = False
         try:
-            root = ElementTree.fromstring(response.body)
-            if root.tag.endswith("sitemapindex"):
-                sitemaps = [sitemap.text for sitemap in root.findall(".//{*}sitemap/{*}loc")]
-                filtered_sitemaps = filter(lambda x: self._filter_sitemap(x, response.meta["last_scraped"]), sitemaps)
-                for sitemap in filtered_sitemaps:
-                    yield scrapy.Request(sitemap, callback=self.parse_sitemap, meta=response.meta)
-            elif root.tag.endswith("urlset"):
-                urls = self.extract_urls_from_sitemap(root, response.meta["last_scraped"], response.url)
-                if urls:
+            for chunk_df in stream:
+                if stream.kind == "sitemapindex":
+                    node = node if node is not None else self._open_index(parent)
+                    children.extend(chunk_df["loc"])
+                    yield from self._child_sitemap_requests(chunk_df["loc"], meta, node)
+                elif stream.kind == "urlset":
                     item = ArticleInsertItem(
-                        newspaper_id=response.meta["newspaper_id"],
-                        school_id=response.meta["school_id"],
-                        df=pd.DataFrame(urls)
+                        newspaper_id=meta["newspaper_id"],
+                        school_id=meta["school_id"],
+                        df=chunk_df
                     )
                     yield item
         except ElementTree.ParseError:
             self.logger.warning(f"Failed to parse sitemap: {response.url}")
+            failed = True
         except (ValueError, HTTPError, URLError) as e:
             self.logger.warning(f"Error processing sitemap {response.url}: {e}")
+            failed = True
+        entry = None
+        if failed and not meta.get("root_probe"):
+            self.fetch_cache.discard(meta["newspaper_id"])
+        else:
+            entry = dict(url=response.url,
+                         etag=self._header(response, "ETag"),
+                         last_modified=self._header(response, "Last-Modified"),
+                         body_hash=body_hash,
+                         sitemaps=children if stream.kind == "sitemapindex" else None,
+                         owner=meta["newspaper_id"])
+        if node is None:
+            if entry:
+                self.fetch_cache.record(**entry)
+            self._sitemap_read(parent, failed)
+        else:
+            state = self.sitemap_indexes[node]
+            state.update(parsing=False, entry=entry, failed=state["failed"] or failed)
+            self._settle_index(node)
+
+    def sitemap_failed(self, failure):
+        """Errback of sitemap requests: keep the newspaper's fetch cache from being persisted,
+        so the sitemap and the indexes listing it are fetched again next crawl"""
+        request = failure.request
+        self.logger.warning(f"Failed to fetch sitemap {request.url}: {failure.value!r}")
+        self.crawler.stats.inc_value("sitemaps/failed")
+        self.fetch_cache.discard(request.meta["newspaper_id"])
+        self._sitemap_read(request.meta.get("parent_sitemap"), failed=True)
+
+    def root_sitemap_failed(self, failure):
+        """Errback of the speculative {base_url}sitemap.xml request. Most sites have none, so
+        the newspaper's fetch cache is kept"""
+        request = failure.request
+        self.logger.debug(f"No root sitemap at {request.url}: {failure.value!r}")
+        self.crawler.stats.inc_value("sitemaps/root_missing")
+        self._sitemap_read(request.meta.get("parent_sitemap"))
+
+    def closed(self, reason):
+        """Persist the fetch cache for newspapers whose links were all stored"""
+        self.fetch_cache.flush(all_owners=True)
+        self.dbconn.close(commit=True)
+
+    def _cached_sitemap_requests(self, url, meta, parent):
+        """Requests for the sitemaps of an unchanged index, as cached when it was last read"""
+        children = self.fetch_cache.sitemaps(url)
+        if not children:
+            self._sitemap_read(parent)
+            return
+        node = self._open_index(parent)
+        yield from self._child_sitemap_requests(children, meta, node)
+        self.sitemap_indexes[node]["parsing"] = False
+        self._settle_index(node)
+
+    def _child_sitemap_requests(self, sitemaps, meta, node):
+        """Requests for the sitemaps listed by index node, counting them as outstanding"""
+        for sitemap in sitemaps:
+            if self._filter_sitemap(sitemap, meta["last_scraped"]):
+                request = self._sitemap_request(sitemap, meta, parent=node)
+                if request is not None:
+                    self.sitemap_indexes[node]["children_left"] += 1
+                    yield request
+
+    def _open_index(self, parent):
+        """Start tracking a sitemap index whose sitemaps are being requested"""
+        node = self.next_sitemap_node
+        self.next_sitemap_node += 1
+        self.sitemap_indexes[node] = {"parent": parent, "children_left": 0, "parsing": True,
+                                      "failed": False, "entry": None}
+        return node
+
+    def _sitemap_read(self, parent, failed=False):
+        """Count one sitemap of index parent as read, or failed"""
+        if parent is None:
+            return
+        state = self.sitemap_indexes[parent]
+        state["children_left"] -= 1
+        state["failed"] = state["failed"] or failed
+        self._settle_index(parent)
+
+    def _settle_index(self, node):
+        """Once an index is parsed and all its sitemaps are read, record it unless one failed"""
+        state = self.sitemap_indexes[node]
+        if state["parsing"] or state["children_left"] > 0:
+            return
+        del self.sitemap_indexes[node]
+        if state["entry"] and not state["failed"]:
+            self.fetch_cache.record(**state["entry"])
+        self._sitemap_read(state["parent"], state["failed"])
+
+    def _visit_sitemap(self, url, newspaper_id):
+        """Mark a sitemap as visited for a newspaper, False if it already was"""
+        url = urldefrag(url.strip())[0]
+        visited = self.visited_sitemaps.setdefault(newspaper_id, set())
+        if url in visited:
+            self.crawler.stats.inc_value("sitemaps/duplicate")
+            return False
+        visited.add(url)
+        return True
+
+    def _sitemap_request(self, url, meta, parent=None, root_probe=False):
+        """
+        Request for a sitemap listed by index node parent, or None if this newspaper
+        already requested it this crawl. Deduplication is per newspaper here, so scrapy's
+        own dupefilter is bypassed. A failed root_probe request does not discard the
+        newspaper's fetch cache.
+        """
+        if not self._visit_sitemap(url, meta["newspaper_id"]):
+            return None
+        request_meta = {key: meta[key] for key in ("base_url", "newspaper_id", "school_id",
+                                                   "last_scraped", "handle_httpstatus_list")}
+        request_meta["parent_sitemap"] = parent
+        request_meta["root_probe"] = root_probe
+        return scrapy.Request(
+            url=url,
+            callback=self.parse_sitemap,
+            errback=self.root_sitemap_failed if root_probe else self.sitemap_failed,
+            headers=self.fetch_cache.request_headers(url),
+            meta=request_meta,
+            dont_filter=True
+        )
+
+    @staticmethod
+    def _header(response, name):
+        """Decoded response header, or None"""
+        value = response.headers.get(name)
+        return value.decode("latin-1") if value else None
 
     def extract_sitemaps_from_robots(self, robots_txt):
         """Extract sitemap URLs from robots.txt."""
@@ -415,18 +704,6 @@ class ArticleInsertSpider(scrapy.Spider):
                     pass  # Ignore parsing errors and proceed
         return True
 
-    def extract_urls_from_sitemap(self, root, last_scraped, sitemap_url):
-        """Vectorized extraction of URLs."""
-        urls = []
-        for url_node in root.findall(".//{*}url"):
-            loc = url_node.find(".//{*}loc")
-            lastmod = url_node.find(".//{*}lastmod")
-            if loc is not None:
-                lastmod_date = pd.to_datetime(lastmod.text, errors="coerce", utc=True) if lastmod else None
-                if not last_scraped or (lastmod_date and lastmod_date >= pd.to_datetime(last_scraped, utc=True)):
-                    urls.append({"loc": loc.text, "lastmod": lastmod_date, "sitemap": sitemap_url})
-        return urls
-
     def _get_base_url(self, url):
         """Extract the base URL from a full URL."""
         parsed_url = urlparse(url)
@@ -0,0 +1,36 @@
+"""Module for splitting article urls into the directory columns of the articles table."""
+from urllib.parse import unquote
+import pandas as pd
+
+N_DIRS = 5
+DIR_COLUMNS = [f"dir_{i}" for i in range(1, N_DIRS + 1)]
+
+def url_dirs(urls: pd.Series) -> pd.DataFrame:
+    """
+    Split urls into dir_1..dir_5 and last_dir using vectorized string operations.
+
+    Directories are the '/' separated segments of the percent-decoded path, as in advertools'
+    url_to_df, but only the columns stored in articles are computed. Missing directories are None.
+
+    Args:
+        urls (pd.Series): Absolute urls.
+
+    Returns:
+        pd.DataFrame: dir_1..dir_5 and last_dir columns, with the same index as urls, so the
+        result can be concatenated or assigned onto the urls' frame without a merge.
+    """
+    paths = urls.astype(str) \
+        .str.replace(r"^[^:/?#]+://[^/?#]*", "", regex=True) \
+        .str.replace(r"[?#].*$", "", regex=True) \
+        .str.strip("/") \
+        .where(urls.notna(), "")
+    encoded = paths.str.contains("%", regex=False)
+    if encoded.any():
+        paths = paths.copy()
+        paths[encoded] = paths[encoded].map(unquote)
+    parts = paths.str.split("/", n=N_DIRS)
+    dirs_df = pd.DataFrame({column: parts.str.get(i) for i, column in enumerate(DIR_COLUMNS)},
+                           index=urls.index)
+    dirs_df["last_dir"] = paths.str.rsplit("/", n=1).str.get(-1)
+    dirs_df = dirs_df.astype(object)
+    return dirs_df.where(dirs_df.notna() & (dirs_df != ""), None)